@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# Copyright (c) 2018 Kevin Murray <kdmfoss@gmail.com>
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Compare `tstk downsize` and `tstk ingest` run with the process and thread executors.
+
+    python benchmarks/executors.py -j 8 -n 200 --size 2000x3000
+
+Synthetic JPEGs are written to a temporary timestream, which each command then reads.
+"""
+
+from click.testing import CliRunner
+import imageio
+import numpy as np
+
+from pyts2.commandline import tstk_main
+from pyts2.utils import XbyY2XY
+
+import argparse
+import datetime as dt
+import os
+import os.path as op
+import tempfile
+import time
+
+
+def make_input(path, nimages, size):
+    rows, cols = XbyY2XY(size)
+    rng = np.random.default_rng(42)
+    # noise won't compress, so make a smooth-ish image to keep jpegs a realistic size
+    base = rng.integers(0, 256, size=(rows // 8 + 1, cols // 8 + 1, 3), dtype="u1")
+    pixels = np.kron(base, np.ones((8, 8, 1), dtype="u1"))[:rows, :cols]
+    start = dt.datetime(2020, 1, 1, 0, 0, 0)
+    for i in range(nimages):
+        when = start + dt.timedelta(minutes=5 * i)
+        fn = op.join(path, when.strftime("bench_%Y_%m_%d_%H_%M_%S_00.jpg"))
+        imageio.imwrite(fn, pixels, quality=90)
+
+
+def run(args):
+    start = time.perf_counter()
+    result = CliRunner().invoke(tstk_main, args, catch_exceptions=False)
+    elapsed = time.perf_counter() - start
+    if result.exit_code != 0:
+        raise RuntimeError(f"tstk {' '.join(args)} failed:\n{result.output}")
+    return elapsed
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("-j", "--ncpus", type=int, default=4, help="Number of parallel workers")
+    ap.add_argument("-n", "--nimages", type=int, default=100, help="Number of input images")
+    ap.add_argument("-s", "--size", default="2000x3000", help="Input image size, ROWSxCOLS")
+    ap.add_argument("-r", "--repeats", type=int, default=3, help="Keep the best of this many runs")
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        inpath = op.join(tmp, "input")
+        os.makedirs(inpath)
+        make_input(inpath, args.nimages, args.size)
+
+        commands = {
+            "downsize": lambda out: ["downsize", "-s", "720x", "-o", out, inpath],
+            "ingest": lambda out: ["ingest", "-b", "day", "-s", out + "-small", "-o", out, inpath],
+        }
+        print(f"{args.nimages} images of {args.size}, -j {args.ncpus}")
+        print("command\texecutor\tseconds\timages/s")
+        for command, cmdargs in commands.items():
+            for executor in ("process", "thread"):
+                times = []
+                for rep in range(args.repeats):
+                    out = op.join(tmp, f"{command}-{executor}-{rep}")
+                    times.append(run(cmdargs(out) + ["-j", str(args.ncpus), "--executor", executor]))
+                best = min(times)
+                print(f"{command}\t{executor}\t{best:.2f}\t{args.nimages / best:.1f}")
+
+
+if __name__ == "__main__":
+    main()
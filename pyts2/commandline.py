@@ -11,7 +11,7 @@ import numpy as np
 
 import pyts2
 from pyts2 import TimeStream
-from pyts2.timestream import FileContentFetcher
+from pyts2.timestream import FileContentFetcher, join_timestreams
 from pyts2.time import TimeFilter, parse_date
 from pyts2.pipeline import *
 from pyts2.pipeline.base import LiveResultRecorder
@@ -22,6 +22,7 @@ from pyts2.removalist import Removalist
 from os.path import dirname, basename, splitext, getsize, realpath
 from sys import stdout, stderr, stdin, exit  # noqa
 from csv import DictWriter
+from contextlib import ExitStack
 import datetime
 import argparse
 import multiprocessing as mp
@@ -77,10 +78,11 @@ def bundle(force, informat, bundle, input, output):
         click.echo(f"ERROR: output exists: {output}", err=True)
         sys.exit(1)
     output = TimeStream(output, bundle_level=bundle)
-    for image in input:
-        with CatchSignalThenExit():
-            output.write(image)
-        click.echo(f"Processing {image}")
+    with output.writer():
+        for image in input:
+            with CatchSignalThenExit():
+                output.write(image)
+            click.echo(f"Processing {image}")
 
 
 @tstk_main.command()
@@ -88,6 +90,8 @@ def bundle(force, informat, bundle, input, output):
               help="Output TSV file name")
 @click.option("--ncpus", "-j", default=getncpu(),
               help="Number of parallel workers")
+@click.option("--executor", default="process", type=Choice(("process", "thread")),
+              help="Run parallel workers as processes, or as threads sharing memory (faster when steps release the GIL)")
 @click.option("--informat", "-F", default=None,
               help="Input image format (use extension as lower case for raw formats)")
 @click.option("--telegraf-host", default=None,
@@ -96,9 +100,16 @@ def bundle(force, informat, bundle, input, output):
               help="Telegraf reporting port")
 @click.option("--telegraf-metric", default='tstk_audit',
               help="Telegraf reporting metric name")
+@click.option("--report-step-times", is_flag=True, default=False,
+              help="Add the time each step took on each file to the output TSV")
+@click.option("--profile-memory", is_flag=True, default=False,
+              help="Measure and summarise each step's memory use (slow)")
 @click.argument("input")
-def audit(input, output, telegraf_host, telegraf_port, telegraf_metric, ncpus=1, informat=None):
+def audit(input, output, telegraf_host, telegraf_port, telegraf_metric, ncpus=1, informat=None, executor="process",
+          report_step_times=False, profile_memory=False):
     from pyts2.pipeline.telegraf import TelegrafRecordStep
+    if profile_memory and executor == "thread" and ncpus > 1:
+        raise click.UsageError("--profile-memory needs --executor process")
     if output is None and telegraf_host is None:
         print("ERROR: must give one of --output or --telegraf-host")
         sys.exit(1)
@@ -109,6 +120,8 @@ def audit(input, output, telegraf_host, telegraf_port, telegraf_metric, ncpus=1,
         DecodeImageFileStep(),
         ImageMeanColourStep(),
         ScanQRCodesStep(),
+        report_step_times=report_step_times,
+        profile_memory=profile_memory,
     )
 
     if telegraf_host is not None:
@@ -120,11 +133,12 @@ def audit(input, output, telegraf_host, telegraf_port, telegraf_metric, ncpus=1,
 
     ints = TimeStream(input, format=informat)
     try:
-        for image in pipe.process(ints, ncpus=ncpus):
+        for image in pipe.process(ints, ncpus=ncpus, results="report", executor=executor):
             if output is not None:
                 if pipe.n % 1000 == 0:
                     pipe.report.save(output)
     finally:
+        pipe.finish()
         if output is not None:
             pipe.report.save(output)
         fmt = "" if informat is None else f":{informat}"
@@ -138,6 +152,8 @@ def audit(input, output, telegraf_host, telegraf_port, telegraf_metric, ncpus=1,
               help="Output TimeStream")
 @click.option("--ncpus", "-j", default=getncpu(),
               help="Number of parallel workers")
+@click.option("--executor", default="process", type=Choice(("process", "thread")),
+              help="Run parallel workers as processes, or as threads sharing memory (faster when steps release the GIL)")
 @click.option("--informat", "-F", default=None,
               help="Input image format (use extension as lower case for raw formats)")
 @click.option("--outformat", "-f", default="jpg", type=Choice(("jpg", "png", "tif")),
@@ -151,8 +167,12 @@ def audit(input, output, telegraf_host, telegraf_port, telegraf_metric, ncpus=1,
               help="Output size. Use ROWSxCOLS. One of ROWS or COLS can be omitted to keep aspect ratio.")
 @click.option("--flat", is_flag=True, default=False,
               help="Output all images to a single directory (flat timestream structure).")
+@click.option("--profile-memory", is_flag=True, default=False,
+              help="Measure and summarise each step's memory use (slow)")
 @click.argument("input")
-def downsize(input, output, ncpus, informat, outformat, size, bundle, mode, flat):
+def downsize(input, output, ncpus, executor, informat, outformat, size, bundle, mode, flat, profile_memory):
+    if profile_memory and executor == "thread" and ncpus > 1:
+        raise click.UsageError("--profile-memory needs --executor process")
     if mode == "resize":
         downsizer = ResizeImageStep(geom=size)
     elif mode == "centrecrop" or mode == "crop":
@@ -161,12 +181,14 @@ def downsize(input, output, ncpus, informat, outformat, size, bundle, mode, flat
         DecodeImageFileStep(),
         downsizer,
         EncodeImageFileStep(format=outformat),
+        profile_memory=profile_memory,
     )
     ints = TimeStream(input, format=informat)
     outts = TimeStream(output, format=outformat, bundle_level=bundle, add_subsecond_field=True, flat_output=flat)
     try:
-        pipe.process_to(ints, outts, ncpus=ncpus)
+        pipe.process_to(ints, outts, ncpus=ncpus, executor=executor)
     finally:
+        pipe.finish()
         click.echo(f"{mode} {input}:{informat} to {output}:{outformat}, found {pipe.n} files")
 
 
@@ -183,6 +205,8 @@ def downsize(input, output, ncpus, informat, outformat, size, bundle, mode, flat
               help="Level at which to bundle files.")
 @click.option("--ncpus", "-j", default=getncpu(),
               help="Number of parallel workers")
+@click.option("--executor", default="process", type=Choice(("process", "thread")),
+              help="Run parallel workers as processes, or as threads sharing memory (faster when steps release the GIL)")
 @click.option("--downsized-output", "-s", default=None,
               help="Output a downsized copy of the images here")
 @click.option("--downsized-size", "-S", default='720x',
@@ -191,11 +215,18 @@ def downsize(input, output, ncpus, informat, outformat, size, bundle, mode, flat
               help="Level at which to bundle downsized images.")
 @click.option("--audit-output", "-a", type=Path(writable=True), default=None,
               help="Audit log output TSV. If given, input images will be audited, with the log saved here.")
-def ingest(input, informat, output, bundle, ncpus, downsized_output, downsized_size, downsized_bundle, audit_output):
+@click.option("--report-step-times", is_flag=True, default=False,
+              help="Add the time each step took on each file to the audit log")
+@click.option("--profile-memory", is_flag=True, default=False,
+              help="Measure and summarise each step's memory use (slow)")
+def ingest(input, informat, output, bundle, ncpus, executor, downsized_output, downsized_size, downsized_bundle, audit_output,
+           report_step_times, profile_memory):
+    if profile_memory and executor == "thread" and ncpus > 1:
+        raise click.UsageError("--profile-memory needs --executor process")
     ints = TimeStream(input, format=informat)
     outts = TimeStream(output, bundle_level=bundle)
 
-    steps = [WriteFileStep(outts)]
+    steps = []
 
     # if downsized_output is not None or audit_output is not None:
     #    steps.append(DecodeImageFileStep())
@@ -220,17 +251,43 @@ def ingest(input, informat, output, bundle, ncpus, downsized_output, downsized_s
         )
         steps.append(downsize_pipeline)
 
-    pipe = TSPipeline(*steps)
+    pipe = TSPipeline(*steps, report_step_times=report_step_times, profile_memory=profile_memory)
 
+    def write_originals(instream, write):
+        # Originals are written as they're taken from the input, while the pipeline works
+        # on those taken before them
+        for image in instream:
+            write(image)
+            yield image
+
+    nfiles = 0
+    writer = None
     try:
-        for image in pipe.process(ints, ncpus=ncpus):
-            pass
+        with ExitStack() as stack:
+            if executor == "thread" or ncpus <= 1:
+                # Written here, in a writer session: with threads (or no workers at all),
+                # handing originals to writer processes would cost more than it saves
+                stack.enter_context(outts.writer())
+                write = outts.write
+            else:
+                # Written by writer processes which each own some of the bundles, and read
+                # the originals themselves, rather than by every pipeline worker contending
+                # for the same bundle
+                writer = stack.enter_context(outts.parallel_writer(ncpus))
+                write = writer.write
+            images = write_originals(ints, write)
+            if steps:
+                images = pipe.process(images, ncpus=ncpus, results="report", executor=executor)
+            for image in images:
+                nfiles += 1
+        if writer is not None and writer.errors:
+            pipe.retcode = 1
     finally:
         pipe.finish()
         if audit_output is not None:
             pipe.report.save(audit_output)
         ifmt = f":{informat}" if informat is not None else ""
-        click.echo(f"Ingested {input}{ifmt} to {output}, found {pipe.n} files")
+        click.echo(f"Ingested {input}{ifmt} to {output}, found {nfiles} files")
         sys.exit(pipe.retcode)
 
 @tstk_main.command()
@@ -276,13 +333,18 @@ def ingest(input, informat, output, bundle, ncpus, downsized_output, downsized_s
               help="DELETE file UNSAFELY as it finishes processsing")
 @click.option("--truncate-time", type=str, default=None, metavar="TIME",
               help="Truncate time to TIME")
-def liveingest(input, informat, output, bundle, inotify_watch, nuke, min_mean_luminance, truncate_time,
+@click.option("--ncpus", "-j", default=getncpu(),
+              help="Number of threads for decoding and scanning images")
+@click.option("--io-threads", default=8,
+              help="Number of threads for writing, deleting and sending metrics")
+def liveingest(input, informat, output, bundle, inotify_watch, nuke, min_mean_luminance, truncate_time, ncpus, io_threads,
                downsized_output, downsized_size, downsized_bundle,
                recoded_output, recoded_format, recoded_bundle,
                centrecropped_output, centrecropped_size, centrecropped_bundle,
                telegraf_host, telegraf_port, telegraf_metric, telegraf_additional_tags,
                ):
     from pyts2.pipeline.telegraf import TelegrafRecordStep
+    from pyts2.pipeline.live import AsyncPipelineRunner
     ifmt = f"{informat}s" if informat is not None else "images"
     click.echo(f"Begin live ingest of {ifmt} to {output}...")
 
@@ -351,10 +413,8 @@ def liveingest(input, informat, output, bundle, inotify_watch, nuke, min_mean_lu
             instream = ints.from_inotify(inotify_watch)
         else:
             instream = ints.from_fofn(input)
-        for image in instream:
-            image = pipe.process_file(image)
-            click.echo(f"{image.filename} Done")
-            pipe.n += 1
+        runner = AsyncPipelineRunner(pipe, ncpus=ncpus, io_threads=io_threads)
+        runner.run(instream, on_done=lambda image: click.echo(f"{image.filename} Done"))
     finally:
         pipe.finish()
         click.echo(f"Ingested {ifmt} to {output}, found {pipe.n} files")
@@ -397,10 +457,19 @@ def verify(ephemerals, resource, informat, force_delete, rm_script, move_dest, p
         for ephemeral in ephemerals:
             click.echo(f"Crawling ephemeral timestream: {ephemeral}")
             ephemeral_ts = TimeStream(ephemeral, format=informat)
+            extent = ephemeral_ts.extent()
+            if extent is None:
+                continue
+            # both sides in time order, and only the part of the resource that could match
+            first, last = extent
+            resource_imgs = resource_ts.range(first, last.datetime + datetime.timedelta(seconds=1))
             try:
-                for image in tqdm(ephemeral_ts, unit=" files"):
+                for image, res_img in tqdm(join_timestreams(ephemeral_ts.range(), resource_imgs), unit=" files"):
+                    if image is None:
+                        continue
                     try:
-                        res_img = resource_ts.getinstant(image.instant)
+                        if res_img is None:
+                            raise KeyError(image.instant)
                         if not isinstance(image.fetcher, FileContentFetcher):
                             click.echo(f"WARNING: can't delete {image.filename} as it is bundled", err=True)
                             continue
@@ -532,7 +601,7 @@ def gvmosaic(input, informat, dims, order, audit_output, composite_bundling,
 
     # run pipeline
     try:
-        for image in pipe.process(ints):
+        for image in pipe.process(ints.prefetch()):
             pass
     finally:
         pipe.finish()
@@ -550,22 +619,26 @@ def gvmosaic(input, informat, dims, order, audit_output, composite_bundling,
               help="Start time of day (inclusive)")
 @click.option("--end-time", "-E",
               help="End time of day (inclusive)")
-@click.option("--interval", "-i", type=int,
+@click.option("--interval", "-i", type=click.IntRange(min=1),
               help="Interval in minutes")
+@click.option("--interval-align", default="first", type=Choice(["first", "centre"]),
+              help="Take the first image of each interval, or that nearest its centre")
 @click.option("--start-date", "-s",
               help="Start time of day (inclusive)")
 @click.option("--end-date", "-e",
               help="End time of day (inclusive)")
 @click.argument("input")
 @click.argument("output")
-def cp(informat, bundle, input, output, start_time, start_date, end_time, end_date, interval):
+def cp(informat, bundle, input, output, start_time, start_date, end_time, end_date, interval, interval_align):
     tfilter = TimeFilter(start_date, end_date, start_time, end_time)
+    images = TimeStream(input, format=informat, timefilter=tfilter)
     if interval is not None:
-        raise NotImplementedError("haven't done interval restriction yet")
+        images = images.subsample(datetime.timedelta(minutes=interval), align=interval_align)
     output = TimeStream(output, bundle_level=bundle)
-    for image in tqdm(TimeStream(input, format=informat, timefilter=tfilter)):
-        with CatchSignalThenExit():
-            output.write(image)
+    with output.writer():
+        for image in tqdm(images):
+            with CatchSignalThenExit():
+                output.write(image)
 
 @tstk_main.command()
 @click.option("--informat", "-F", default=None,
@@ -574,18 +647,21 @@ def cp(informat, bundle, input, output, start_time, start_date, end_time, end_da
               help="Start time of day (inclusive)")
 @click.option("--end-time", "-E",
               help="End time of day (inclusive)")
-@click.option("--interval", "-i", type=int,
+@click.option("--interval", "-i", type=click.IntRange(min=1),
               help="Interval in minutes")
+@click.option("--interval-align", default="first", type=Choice(["first", "centre"]),
+              help="Take the first image of each interval, or that nearest its centre")
 @click.option("--start-date", "-s",
               help="Start time of day (inclusive)")
 @click.option("--end-date", "-e",
               help="End time of day (inclusive)")
 @click.argument("input")
-def ls(informat, input, start_time, start_date, end_time, end_date, interval):
+def ls(informat, input, start_time, start_date, end_time, end_date, interval, interval_align):
     tfilter = TimeFilter(start_date, end_date, start_time, end_time)
+    images = TimeStream(input, format=informat, timefilter=tfilter)
     if interval is not None:
-        raise NotImplementedError("haven't done interval restriction yet")
-    for image in TimeStream(input, format=informat, timefilter=tfilter):
+        images = images.subsample(datetime.timedelta(minutes=interval), align=interval_align)
+    for image in images:
         print(image.instant)
 
 
@@ -640,6 +716,26 @@ def findpairs(input, rm_script, move_dest, force_delete):
     findpairs_main(input, rm_script, move_dest, force_delete)
 
 
+@tstk_main.command()
+@click.option("--output", "-o", default=None, type=Path(writable=True),
+              help="Write a re-bundled copy of INPUT here, rather than repacking in place")
+@click.option("--bundle", "-b", type=Choice(TimeStream.bundle_levels), default=None,
+              help="Level at which to bundle --output")
+@click.option("--informat", "-F", default=None,
+              help="Input image format (use extension as lower case for raw formats)")
+@click.argument("input")
+def repack(input, output, bundle, informat):
+    """Rewrite zip bundles with files in time order and duplicates removed."""
+    from pyts2.scripts.repack import repack_main
+    if (output is None) != (bundle is None):
+        click.echo("ERROR: --output and --bundle must be given together", err=True)
+        sys.exit(1)
+    if output is None and informat is not None:
+        click.echo("ERROR: --informat is only supported with --output", err=True)
+        sys.exit(1)
+    repack_main(input, output=output, bundle=bundle, informat=informat)
+
+
 @tstk_main.command()
 @click.option("--output", "-o", type=Path(writable=True),
               help="Output video file name")
@@ -680,7 +776,7 @@ def video(input, output, ffmpeg_path, ffmpeg_args, framerate, scaling, ncpus, in
                 rate=framerate, threads=ncpus, scaling=scaling),
         )
     try:
-        for image in pipe.process(ints, ncpus=1):
+        for image in pipe.process(ints.prefetch(), ncpus=1):
             pass
     finally:
         pipe.finish()
@@ -0,0 +1,365 @@
+# Copyright (c) 2018-2020 Kevin Murray <foss@kdmurray.id.au>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import numpy as np
+
+import datetime
+import json
+import mmap
+import os
+import os.path as op
+import struct
+
+from pyts2.time import TSInstant
+from pyts2.timestream import (
+    FileContentFetcher,
+    TarContentFetcher,
+    TarMember,
+    ZipContentFetcher,
+)
+
+INDEX_MAGIC = b"TSTKIDX1"
+EPOCH = datetime.datetime(1970, 1, 1)
+
+KIND_FILE = 0
+KIND_ZIP = 1
+KIND_TAR = 2
+
+ENTRY_DTYPE = np.dtype([
+    ("epoch", "<i8"),          # seconds since 1970-01-01 of the (naive) instant datetime
+    ("subindex", "<i4"),       # string id of the instant's index, or -1 if it has none
+    ("kind", "u1"),            # KIND_{FILE,ZIP,TAR}
+    ("container", "<i4"),      # string id of the archive, or the directory of a plain file
+    ("name", "<i4"),           # string id of the path within the archive, or the file name
+    ("offset_header", "<i8"),  # tar member offsets & size, or -1 if not known
+    ("offset_data", "<i8"),
+    ("size", "<i8"),
+])
+
+
+def instant_epoch(instant):
+    """Seconds since 1970-01-01 of a TSInstant (or datetime), as stored in the index"""
+    if isinstance(instant, TSInstant):
+        instant = instant.datetime
+    return int((instant - EPOCH).total_seconds())
+
+
+class StringTable(object):
+    """Interned strings, stored as one utf-8 blob plus an array of offsets into it"""
+
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    @classmethod
+    def from_list(cls, strings):
+        encoded = [s.encode("utf-8") for s in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype="<i8")
+        np.cumsum(np.array([len(s) for s in encoded], dtype="<i8"), out=offsets[1:])
+        return cls(offsets, b"".join(encoded))
+
+    def __getitem__(self, i):
+        if i < 0:
+            return None
+        return bytes(self.blob[self.offsets[i]:self.offsets[i+1]]).decode("utf-8")
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+class TimeStreamIndex(object):
+    """A compact index of the files in a TimeStream, sorted by instant.
+
+    Each file is one fixed-size record in a numpy structured array (see ENTRY_DTYPE),
+    with archive paths, names and instant indices interned in a StringTable. On disk the
+    arrays are stored raw, so loading an index is an mmap and no per-file Python objects
+    are created until a file is actually looked up.
+
+    File layout: magic, uint64 header length, json header, then (8-byte aligned) the
+    entry array, the string offsets and the string blob.
+    """
+
+    def __init__(self, entries, strings, meta=None):
+        self.entries = entries
+        self.strings = strings
+        if meta is None:
+            meta = {}
+        self.meta = meta
+        self._mmap = None
+
+    @classmethod
+    def build(cls, fetchers, meta=None):
+        """Make an index of `fetchers`. Where instants are equal, the last fetcher wins."""
+        strings = {}
+
+        def intern(s):
+            if s is None:
+                return -1
+            return strings.setdefault(str(s), len(strings))
+
+        rows = []
+        for fetcher in fetchers:
+            instant = fetcher.instant
+            offsets = (-1, -1, -1)
+            if isinstance(fetcher, FileContentFetcher):
+                path = str(fetcher.pathondisk)
+                kind, container, name = KIND_FILE, op.dirname(path), op.basename(path)
+            elif isinstance(fetcher, ZipContentFetcher):
+                kind, container, name = KIND_ZIP, fetcher.archivepath, fetcher.pathinzip
+            elif isinstance(fetcher, TarContentFetcher):
+                kind, container, name = KIND_TAR, fetcher.archivepath, fetcher.pathintar
+                if fetcher.member is not None:
+                    m = fetcher.member
+                    offsets = (m.offset_header, m.offset_data, m.size)
+            else:
+                raise TypeError(f"Can't index {fetcher.__class__.__name__}")
+            rows.append(((instant_epoch(instant), instant.index or ""), len(rows),
+                         (instant_epoch(instant), intern(instant.index), kind,
+                          intern(container), intern(name)) + offsets))
+        # sort by instant, keeping insertion order for equal instants
+        rows.sort(key=lambda row: row[:2])
+        entries = np.array([row[2] for row in rows], dtype=ENTRY_DTYPE)
+        table = StringTable.from_list(sorted(strings, key=strings.get))
+        return cls(entries, table, meta=meta)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as fh:
+            mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        if mm[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+            raise ValueError(f"{path} is not a timestream index")
+        pos = len(INDEX_MAGIC)
+        hdrlen, = struct.unpack_from("<Q", mm, pos)
+        pos += 8
+        header = json.loads(bytes(mm[pos:pos+hdrlen]).decode("utf-8"))
+        pos = _align8(pos + hdrlen)
+        n = header["nentries"]
+        entries = np.frombuffer(mm, dtype=ENTRY_DTYPE, count=n, offset=pos)
+        pos = _align8(pos + n * ENTRY_DTYPE.itemsize)
+        offsets = np.frombuffer(mm, dtype="<i8", count=header["nstrings"] + 1, offset=pos)
+        pos += offsets.nbytes
+        blob = memoryview(mm)[pos:pos+header["blobsize"]]
+        index = cls(entries, StringTable(offsets, blob), meta=header.get("meta", {}))
+        index._mmap = mm
+        return index
+
+    def save(self, path):
+        header = json.dumps({"nentries": len(self.entries),
+                             "nstrings": len(self.strings),
+                             "blobsize": len(self.strings.blob),
+                             "meta": self.meta}).encode("utf-8")
+        tmppath = f"{path}.tmp{os.getpid()}"
+        with open(tmppath, "wb") as fh:
+            fh.write(INDEX_MAGIC)
+            fh.write(struct.pack("<Q", len(header)))
+            fh.write(header)
+            _pad8(fh)
+            fh.write(np.ascontiguousarray(self.entries, dtype=ENTRY_DTYPE).tobytes())
+            _pad8(fh)
+            fh.write(np.ascontiguousarray(self.strings.offsets, dtype="<i8").tobytes())
+            fh.write(self.strings.blob)
+        os.replace(tmppath, path)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def instant(self, i):
+        entry = self.entries[i]
+        dt = EPOCH + datetime.timedelta(seconds=int(entry["epoch"]))
+        return TSInstant(dt, self.strings[int(entry["subindex"])])
+
+    def fetcher(self, i):
+        entry = self.entries[i]
+        kind = int(entry["kind"])
+        container = self.strings[int(entry["container"])]
+        name = self.strings[int(entry["name"])]
+        if kind == KIND_FILE:
+            return FileContentFetcher(op.join(container, name))
+        elif kind == KIND_ZIP:
+            return ZipContentFetcher(container, name)
+        elif kind == KIND_TAR:
+            member = None
+            if entry["offset_data"] >= 0:
+                member = TarMember(int(entry["offset_header"]), int(entry["offset_data"]), int(entry["size"]))
+            return TarContentFetcher(container, name, member=member)
+        raise ValueError(f"Bad index entry kind {kind}")
+
+    def filename(self, i):
+        return op.basename(self.strings[int(self.entries[i]["name"])])
+
+    def _epoch_range(self, epoch):
+        epochs = self.entries["epoch"]
+        return (int(np.searchsorted(epochs, epoch, side="left")),
+                int(np.searchsorted(epochs, epoch, side="right")))
+
+    def find(self, instant):
+        """Position of the entry for `instant`, or None"""
+        lo, hi = self._epoch_range(instant_epoch(instant))
+        found = None
+        for i in range(lo, hi):
+            if self.strings[int(self.entries[i]["subindex"])] == instant.index:
+                found = i
+        return found
+
+    def find_file(self, filename):
+        """Position of the entry with basename `filename`, or None"""
+        try:
+            instant = TSInstant.from_path(filename)
+        except ValueError:
+            return None
+        lo, hi = self._epoch_range(instant_epoch(instant))
+        for i in range(lo, hi):
+            if self.filename(i) == op.basename(filename):
+                return i
+        return None
+
+    def _ids_of(self, column, strings):
+        """Mask of entries whose string in `column` is one of `strings`"""
+        ids = np.unique(self.entries[column])
+        wanted = np.array([self.strings[int(i)] in strings for i in ids], dtype=bool)
+        return wanted[np.searchsorted(ids, self.entries[column])]
+
+    def in_containers(self, paths, kind=None):
+        """Mask of entries within any of the archives or directories `paths`"""
+        mask = self._ids_of("container", set(paths))
+        if kind is not None:
+            mask &= self.entries["kind"] == kind
+        return mask
+
+    def file_names(self, dir):
+        """Names of the (non-archived) files in directory `dir`"""
+        return self.file_names_in([dir])[dir]
+
+    def file_names_in(self, dirs):
+        """Names of the (non-archived) files in each of directories `dirs`, as {dir: names}"""
+        names = {dir: set() for dir in dirs}
+        mask = self.in_containers(names, kind=KIND_FILE)
+        for container, name in zip(self.entries["container"][mask], self.entries["name"][mask]):
+            names[self.strings[int(container)]].add(self.strings[int(name)])
+        return names
+
+    def merge(self, keep, other, meta=None):
+        """A new index of the entries selected by mask `keep` (default all), plus those of `other`
+
+        Entries of `other` replace any of ours for the same file. Strings of dropped
+        entries are left in the string table, rather than rewriting it.
+        """
+        if keep is None:
+            keep = np.ones(len(self), dtype=bool)
+        keep = keep.copy()
+        theirs = {(other.strings[int(c)], other.strings[int(n)])
+                  for c, n in zip(other.entries["container"], other.entries["name"])}
+        if theirs:
+            for i in np.flatnonzero(keep & self.in_containers({c for c, _ in theirs})):
+                entry = self.entries[i]
+                if (self.strings[int(entry["container"])], self.strings[int(entry["name"])]) in theirs:
+                    keep[i] = False
+        nstrings = len(self.strings)
+        theirs = np.array(other.entries, dtype=ENTRY_DTYPE)
+        for column in ("subindex", "container", "name"):
+            ids = theirs[column]
+            ids[ids >= 0] += nstrings
+        entries = np.concatenate([self.entries[keep], theirs])
+        offsets = np.concatenate([self.strings.offsets[:-1], other.strings.offsets + self.strings.offsets[-1]])
+        strings = StringTable(offsets, bytes(self.strings.blob) + bytes(other.strings.blob))
+        merged = TimeStreamIndex(entries, strings, meta=meta)
+        merged._sort()
+        return merged
+
+    def _sort(self):
+        """Sort entries by instant, keeping the existing order of equal instants (as in build)"""
+        subindex = self.entries["subindex"]
+        ids = np.unique(subindex)
+        order = sorted(range(len(ids)), key=lambda i: self.strings[int(ids[i])] or "")
+        rank = np.empty(len(ids), dtype="<i8")
+        rank[order] = np.arange(len(ids))
+        sort = np.lexsort((np.arange(len(self.entries)),
+                           rank[np.searchsorted(ids, subindex)],
+                           self.entries["epoch"]))
+        self.entries = self.entries[sort]
+
+    def span(self, start=None, end=None):
+        """Positions [lo, hi) of the entries from instant `start` up to (not including) `end`"""
+        epochs = self.entries["epoch"]
+        lo = 0 if start is None else int(np.searchsorted(epochs, instant_epoch(start), side="left"))
+        hi = len(self) if end is None else int(np.searchsorted(epochs, instant_epoch(end), side="left"))
+        return lo, max(lo, hi)
+
+    def within(self, timefilter, lo=0, hi=None):
+        """Mask of entries [lo, hi) whose instants pass `timefilter`, a pyts2.time.TimeFilter"""
+        days, seconds = np.divmod(self.entries["epoch"][lo:hi], 86400)
+        mask = np.ones(len(days), dtype=bool)
+
+        def day(date):
+            return (date - EPOCH.date()).days
+
+        def second(time):
+            return time.hour * 3600 + time.minute * 60 + time.second + time.microsecond / 1e6
+
+        if timefilter.startdate is not None:
+            mask &= days >= day(timefilter.startdate)
+        if timefilter.enddate is not None:
+            mask &= days <= day(timefilter.enddate)
+        if timefilter.starttime is not None:
+            mask &= seconds >= second(timefilter.starttime)
+        if timefilter.endtime is not None:
+            mask &= seconds <= second(timefilter.endtime)
+        return mask
+
+    def around(self, instant):
+        """Yields (seconds away, position) of entries in order of distance from `instant`"""
+        epochs = self.entries["epoch"]
+        epoch = instant_epoch(instant)
+        right = int(np.searchsorted(epochs, epoch, side="left"))
+        left = right - 1
+        while left >= 0 or right < len(self):
+            dleft = epoch - int(epochs[left]) if left >= 0 else None
+            dright = int(epochs[right]) - epoch if right < len(self) else None
+            # on a tie, the earlier entry comes first
+            if dright is None or (dleft is not None and dleft <= dright):
+                yield dleft, left
+                left -= 1
+            else:
+                yield dright, right
+                right += 1
+
+    def subsample(self, interval, align="first", mask=None):
+        """Positions of one entry per `interval` seconds, within mask `mask` if given.
+
+        Buckets are aligned to multiples of `interval` since the epoch, so for intervals
+        that divide a day they line up with the clock. Per bucket, the entry chosen is the
+        first ("first") or that nearest the middle of the bucket ("centre").
+        """
+        if align not in ("first", "centre"):
+            raise ValueError(f"align should be first or centre, not {align}")
+        positions = np.arange(len(self)) if mask is None else np.flatnonzero(mask)
+        epochs = self.entries["epoch"][positions]
+        buckets = epochs // interval
+        if align == "first":
+            key = np.zeros_like(epochs)
+        else:
+            # doubled, so that the centre of an odd interval is a whole number
+            key = np.abs(2 * epochs - (2 * buckets * interval + interval))
+        order = np.lexsort((positions, key, buckets))
+        buckets = buckets[order]
+        firsts = np.flatnonzero(np.diff(buckets, prepend=buckets[:1] - 1))
+        return positions[order[firsts]]
+
+    def instants(self):
+        for i in range(len(self)):
+            yield self.instant(i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.fetcher(i)
+
+
+def _align8(pos):
+    return (pos + 7) // 8 * 8
+
+
+def _pad8(fh):
+    fh.write(b"\0" * (_align8(fh.tell()) - fh.tell()))
@@ -6,6 +6,7 @@
 from .base import (
     ResultRecorder,
     TSPipeline,
+    Stage,
     CopyStep,
     WriteFileStep,
     ResultRecorderStep,
@@ -34,6 +35,7 @@ from .verify import UnsafeNuker
 __all__ = [
     "ResultRecorder",
     "TSPipeline",
+    "Stage",
     "CopyStep",
     "WriteFileStep",
     "ResultRecorderStep",
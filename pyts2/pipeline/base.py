@@ -7,15 +7,27 @@
 from tqdm import tqdm
 import msgpack
 
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import ExitStack
 import copy
-from collections import defaultdict
+from functools import partial
+from collections import OrderedDict, defaultdict, deque
 import csv
+import heapq
+import os
 from os import path as op
+import queue
 import re
+import sys
 from sys import stderr, stdout, stdin
+from threading import Event, Lock, Semaphore, Thread
+import time
 import traceback
+import tracemalloc
 import warnings
 
+from ..timestream import TimestreamFile, Fetcher
+
 csv.register_dialect('tsv',
                      delimiter='\t',
                      doublequote=False,
@@ -31,11 +43,201 @@ class FatalPipelineError(Exception):
 class AbortPipelineForThisImage(Exception):
     pass
 
+
+def bounded_map(executor, func, iterable, max_inflight, ordered=True):
+    """Like `executor.map(func, iterable)`, but with at most `max_inflight` tasks submitted.
+
+    `Executor.map` consumes all of `iterable` up front, whereas this only takes the next
+    item once a slot frees up. Results are yielded in input order, unless `ordered` is
+    False, in which case they're yielded as soon as they complete.
+    """
+    if max_inflight < 1:
+        raise ValueError("max_inflight must be at least 1")
+    items = iter(iterable)
+    pending = deque() if ordered else set()
+    submit = pending.append if ordered else pending.add
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and len(pending) < max_inflight:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                submit(executor.submit(func, item))
+            if not pending:
+                return
+            if ordered:
+                yield pending.popleft().result()
+            else:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                pending -= done
+                for fut in done:
+                    yield fut.result()
+    finally:
+        for fut in pending:
+            fut.cancel()
+
+
+# Pipelines run on a thread pool share their ResultRecorders between threads
+_report_lock = Lock()
+
+# The pipeline each pool process builds once, in _init_worker(), and then runs every task on
+_worker_pipeline = None
+
+
+def _init_worker(pipeline):
+    global _worker_pipeline
+    _worker_pipeline = pipeline
+
+
+def _worker_task(file):
+    # Plain files are sent to workers as descriptors, which workers re-open themselves
+    if type(file) is TimestreamFile and file.fetcher is not None:
+        return file.descriptor()
+    return file
+
+
+def _process_in_worker(task, results="file"):
+    # Returns the result, and this task's step statistics for the parent to add to its own
+    if isinstance(task, dict):
+        task = TimestreamFile.from_descriptor(task)
+    file = _worker_pipeline.process_file(task)
+    stats = _worker_pipeline._take_stats()
+    _worker_pipeline._clear_reports()
+    if results == "report" and file is not None:
+        # Leave content and pixels behind, the parent can re-read content if it must
+        fetcher = file.fetcher.dict() if file.fetcher is not None else None
+        return (file.instant, file.filename, fetcher, file.report), stats
+    return file, stats
+
+
+def _file_nbytes(file):
+    """Size of `file`'s content and pixels held in memory, or None if neither is loaded"""
+    nbytes = None
+    if getattr(file, "_content", None) is not None:
+        nbytes = len(file._content)
+    pixels = getattr(file, "_pixels", None)
+    if pixels is not None:
+        nbytes = (nbytes or 0) + pixels.nbytes
+    return nbytes
+
+
+class StepTimings(object):
+    """Per-step call counts, wall and CPU seconds, and bytes in and out of a pipeline's steps.
+
+    Bytes are only counted where they're known, i.e. where a file's content or pixels are
+    in memory when the step finishes.
+    """
+
+    fields = ("Calls", "WallSeconds", "CPUSeconds", "BytesIn", "BytesOut")
+
+    def __init__(self):
+        self.rows = OrderedDict()
+
+    def add(self, name, *values):
+        with _report_lock:
+            row = self.rows.setdefault(name, [0, 0.0, 0.0, 0, 0])
+            for i, val in enumerate(values):
+                row[i] += val
+
+    def merge(self, rows):
+        for name, values in rows.items():
+            self.add(name, *values)
+
+    def reset(self):
+        with _report_lock:
+            self.rows = OrderedDict()
+
+
+def _rss_bytes():
+    """Resident set size of this process, or its high-water mark where that's unavailable"""
+    try:
+        with open("/proc/self/statm") as fh:
+            return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        import resource
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on linux, bytes on macOS
+        return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+class MemoryProfile(object):
+    """Memory growth of each of a pipeline's steps, and the files that needed the most.
+
+    For each step, `rows` holds the number of calls, the highest peak of Python-tracked
+    allocations during a call (from tracemalloc, which also sees numpy arrays), and the
+    total and largest growth in resident set size over a call. `worst` holds the
+    `nworst` (peak, file, step) with the largest peaks, and `max_rss` the largest RSS seen
+    in any one process, i.e. the footprint of a worker.
+    """
+
+    def __init__(self, nworst=10):
+        self.nworst = nworst
+        self.reset()
+
+    def add(self, name, filename, peak, rss_growth, rss):
+        with _report_lock:
+            row = self.rows.setdefault(name, [0, 0, 0, 0])
+            row[0] += 1
+            row[1] = max(row[1], peak)
+            row[2] += rss_growth
+            row[3] = max(row[3], rss_growth)
+            self.max_rss = max(self.max_rss, rss)
+            item = (peak, filename, name)
+            if len(self.worst) < self.nworst:
+                heapq.heappush(self.worst, item)
+            elif item > self.worst[0]:
+                heapq.heapreplace(self.worst, item)
+
+    def merge(self, other):
+        with _report_lock:
+            for name, (calls, peak, growth, maxgrowth) in other.rows.items():
+                row = self.rows.setdefault(name, [0, 0, 0, 0])
+                row[0] += calls
+                row[1] = max(row[1], peak)
+                row[2] += growth
+                row[3] = max(row[3], maxgrowth)
+            self.max_rss = max(self.max_rss, other.max_rss)
+            self.worst = heapq.nlargest(self.nworst, self.worst + other.worst)
+            heapq.heapify(self.worst)
+
+    def take(self):
+        """A copy of this profile, which is then cleared"""
+        with _report_lock:
+            taken = MemoryProfile(self.nworst)
+            taken.rows, taken.worst, taken.max_rss = self.rows, self.worst, self.max_rss
+            self.rows, self.worst, self.max_rss = OrderedDict(), [], 0
+        return taken
+
+    def reset(self):
+        self.rows = OrderedDict()
+        self.worst = []
+        self.max_rss = 0
+
+
+def _from_worker_report(result):
+    instant, filename, fetcher, report = result
+    if fetcher is None:
+        return TimestreamFile(instant=instant, filename=filename, content=b'', report=report)
+    return TimestreamFile(instant=instant, filename=filename, fetcher=Fetcher.from_json(fetcher),
+                          report=report)
+
+
 class TSPipeline(object):
-    def __init__(self, *args, reporter=None):
+    def __init__(self, *args, reporter=None, report_step_times=False, profile_memory=False):
         self.retcode = 0 
         self.n = 0
         self.steps = []
+        self.step_names = []
+        self.timings = StepTimings()
+        # add each step's wall time to every file's report, as StepSeconds_<step>
+        self.report_step_times = report_step_times
+        # measure each step's memory use, see MemoryProfile. This slows things down.
+        self.profile_memory = profile_memory
+        self.memory = MemoryProfile()
+        self._started_tracing = False
         for step in args:
             self.add_step(step)
         if reporter is None:
@@ -45,63 +247,270 @@ class TSPipeline(object):
     def add_step(self, step):
         if not hasattr(step, "process_file"):
             raise ValueError(f"step doesn't seem to be a pipeline step: {step}")
+        name = step.__class__.__name__
+        if name in self.step_names:
+            name = f"{name}#{sum(n.split('#')[0] == name for n in self.step_names) + 1}"
         self.steps.append(step)
+        self.step_names.append(name)
         return self  # so one can chain calls
 
     def process_file(self, file):
         # This should mirror PipelineStep, so an entire pipeline can function
         # as a pipeline step
-        for step in self.steps:
-            file.report["Errors"] = None
-            try:
-                file = step.process_file(file)
-                assert file is not None
-            except AbortPipelineForThisImage as exc:
-                file.report.update({"PipelineAbortedMessage": str(exc)})
-                print(f"\nAborting at {step.__class__.__name__}: {str(exc)}", file=stderr)
-                break
-            except Exception as exc:
-                path = file.filename
-                if hasattr(file.fetcher, "pathondisk"):
-                    path = file.fetcher.pathondisk
-                print(f"\n{exc.__class__.__name__}: {str(exc)} while processing '{path}'\n", file=stderr)
-                if stderr.isatty():
-                    traceback.print_exc(file=stderr)
-                file.report["Errors"] = f"{exc.__class__.__name__}: {str(exc)}"
-                self.report.record(file.instant, **file.report)
-                if isinstance(exc, FatalPipelineError):
-                    raise
-        self.report.record(file.instant, **file.report)
+        file, aborted = self._run_steps(file)
         return file
 
-    def process(self, input_stream, ncpus=1, progress=True):
+    def _run_steps(self, file):
+        """Run each step on `file`, returning the file and whether a step aborted it"""
+        aborted = False
+        for i in range(len(self.steps)):
+            file, aborted = self._run_step(i, file)
+            if aborted:
+                break
+        with _report_lock:
+            self.report.record(file.instant, **file.report)
+        return file, aborted
+
+    def _run_step(self, i, file):
+        """Run the `i`th step on `file`, returning the file and whether the step aborted it"""
+        # by position, as the same step may be in a pipeline twice
+        step, name = self.steps[i], self.step_names[i]
+        file.report["Errors"] = None
+        infile = file
+        if self.profile_memory:
+            mem = self._memory_before_step()
+        wall, cpu = time.perf_counter(), time.thread_time()
         try:
-            from concurrent.futures import as_completed, ThreadPoolExecutor, ProcessPoolExecutor
-            if ncpus > 1:
-                with ProcessPoolExecutor(max_workers=ncpus) as executor:
-                        for file in tqdm(executor.map(self.process_file, input_stream), unit=" files"):
-                            if file is None:
-                                continue
-                            self.report.record(file.instant, **file.report)
-                            self.n += 1
-                            yield file
-            else:
-                for file in tqdm(input_stream, unit=" files"):
-                    file = self.process_file(file)
+            file = step.process_file(file)
+            assert file is not None
+        except AbortPipelineForThisImage as exc:
+            self._time_step(name, infile, None, wall, cpu)
+            if self.profile_memory:
+                self._memory_after_step(name, infile, mem)
+            file.report.update({"PipelineAbortedMessage": str(exc)})
+            print(f"\nAborting at {step.__class__.__name__}: {str(exc)}", file=stderr)
+            return file, True
+        except Exception as exc:
+            path = file.filename
+            if hasattr(file.fetcher, "pathondisk"):
+                path = file.fetcher.pathondisk
+            print(f"\n{exc.__class__.__name__}: {str(exc)} while processing '{path}'\n", file=stderr)
+            if stderr.isatty():
+                traceback.print_exc(file=stderr)
+            file.report["Errors"] = f"{exc.__class__.__name__}: {str(exc)}"
+            with _report_lock:
+                self.report.record(file.instant, **file.report)
+            if isinstance(exc, FatalPipelineError):
+                raise
+        self._time_step(name, infile, file, wall, cpu)
+        if self.profile_memory:
+            self._memory_after_step(name, file, mem)
+        return file, False
+
+    def _memory_before_step(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        tracemalloc.reset_peak()
+        return tracemalloc.get_traced_memory()[0], _rss_bytes()
+
+    def _memory_after_step(self, name, file, before):
+        # NB: allocations are per process, so with a thread pool they include other threads'
+        traced_before, rss_before = before
+        peak = max(tracemalloc.get_traced_memory()[1] - traced_before, 0)
+        rss = _rss_bytes()
+        self.memory.add(name, file.filename, peak, rss - rss_before, rss)
+        peak_mb = round(peak / 1024**2, 1)
+        if peak_mb > file.report.get("MemoryPeakMB", 0):
+            file.report["MemoryPeakMB"] = peak_mb
+
+    def _time_step(self, name, infile, outfile, wall, cpu):
+        wall = time.perf_counter() - wall
+        cpu = time.thread_time() - cpu
+        # measured after the step, so content it loaded into the input file counts
+        nin = _file_nbytes(infile) or 0
+        nout = (_file_nbytes(outfile) or 0) if outfile is not None else 0
+        self.timings.add(name, 1, wall, cpu, nin, nout)
+        if self.report_step_times:
+            infile.report[f"StepSeconds_{name}"] = round(wall, 6)
+
+    def all_memory(self, reset=False):
+        """The memory profile of this pipeline's steps, including those within Stages"""
+        memory = MemoryProfile(self.memory.nworst)
+        memory.merge(self.memory.take() if reset else self.memory)
+        for step in self.steps:
+            if isinstance(step, Stage):
+                memory.merge(step.all_memory(reset=reset))
+        return memory
+
+    def _take_stats(self):
+        # statistics a pool worker sends back to the parent with each result
+        return self.all_timings(reset=True), self.all_memory(reset=True)
+
+    def _clear_reports(self):
+        # Pool workers send each file's report back with the file, which the parent records,
+        # so they needn't keep their own copies of every report
+        if type(self.report) is ResultRecorder:
+            self.report = ResultRecorder()
+        for step in self.steps:
+            child = step.pipe if isinstance(step, TeeStep) else step
+            if isinstance(child, TSPipeline):
+                child._clear_reports()
+
+    def _merge_stats(self, stats):
+        timings, memory = stats
+        self.timings.merge(timings)
+        self.memory.merge(memory)
+
+    def all_timings(self, prefix="", reset=False):
+        """Step timings of this pipeline and those nested in it, as {step name: values}.
+
+        Steps of a pipeline nested in this one (directly or in a TeeStep) are named like
+        "TSPipeline/DecodeImageFileStep"; steps within a Stage are named as if they were
+        steps of this pipeline. With `reset=True`, timings are cleared once taken.
+        """
+        rows = OrderedDict()
+
+        def add(name, values):
+            row = rows.setdefault(name, [0, 0.0, 0.0, 0, 0])
+            for i, val in enumerate(values):
+                row[i] += val
+
+        for name, values in list(self.timings.rows.items()):
+            add(prefix + name, values)
+        if reset:
+            self.timings.reset()
+        for name, step in zip(self.step_names, self.steps):
+            child = step.pipe if isinstance(step, TeeStep) else step
+            if not isinstance(child, TSPipeline):
+                continue
+            childprefix = prefix if isinstance(child, Stage) else f"{prefix}{name}/"
+            for childname, values in child.all_timings(childprefix, reset=reset).items():
+                add(childname, values)
+        return rows
+
+    def process(self, input_stream, ncpus=1, progress=True, max_inflight=None, ordered=True,
+                results="file", executor="process"):
+        """Process each file of `input_stream`, yielding processed files.
+
+        With `ncpus > 1`, files are processed on a pool of `ncpus` processes, with at most
+        `max_inflight` files (default `4 * ncpus`) submitted to the pool at once. Output
+        follows input order, unless `ordered=False`, where files are yielded as they finish.
+        Each pool process receives this pipeline once, when it starts; tasks only carry a
+        description of where to read each file from.
+
+        `results` says what the caller needs back from pool processes. With "file", each
+        processed file is sent back whole. With "report", only its report is, and files are
+        yielded without content or pixels (content is re-read on access, if it came from a
+        timestream). Use "report" when the pipeline itself writes all its outputs.
+
+        With `executor="thread"`, a pool of `ncpus` threads is used instead. Nothing is
+        copied or pickled, so this is faster for pipelines whose steps spend their time in
+        code that releases the GIL (decoding, encoding, resizing, I/O).
+
+        If any of this pipeline's steps is a `Stage`, the pipeline runs stage-parallel
+        instead, and `ncpus`, `executor` and `results` are ignored: see `Stage`.
+        """
+        if any(isinstance(step, Stage) for step in self.steps):
+            yield from self._process_staged(input_stream, max_inflight=max_inflight, ordered=ordered)
+            return
+        if results not in ("file", "report"):
+            raise ValueError(f"results must be 'file' or 'report', not {results!r}")
+        if executor not in ("process", "thread"):
+            raise ValueError(f"executor must be 'process' or 'thread', not {executor!r}")
+        if self.profile_memory and ncpus > 1 and executor == "thread":
+            # tracemalloc counts a whole process's allocations, so would mix threads' steps up
+            raise ValueError("profile_memory needs worker processes, not threads")
+        if max_inflight is None:
+            max_inflight = 4 * ncpus
+        try:
+            with ExitStack() as stack:
+                if ncpus > 1 and executor == "thread":
+                    pool = stack.enter_context(ThreadPoolExecutor(max_workers=ncpus))
+                    done = bounded_map(pool, self.process_file, input_stream,
+                                       max_inflight=max_inflight, ordered=ordered)
+                elif ncpus > 1:
+                    pool = stack.enter_context(ProcessPoolExecutor(
+                        max_workers=ncpus, initializer=_init_worker, initargs=(self,)))
+                    tasks = (_worker_task(file) for file in input_stream)
+                    done = bounded_map(pool, partial(_process_in_worker, results=results), tasks,
+                                       max_inflight=max_inflight, ordered=ordered)
+                    done = self._merge_worker_stats(done)
+                    if results == "report":
+                        done = (_from_worker_report(r) if r is not None else None for r in done)
+                else:
+                    done = (self.process_file(file) for file in input_stream)
+                for file in tqdm(done, unit=" files"):
                     if file is None:
                         continue
-                    self.report.record(file.instant, **file.report)
+                    with _report_lock:
+                        self.report.record(file.instant, **file.report)
                     self.n += 1
                     yield file
         except FatalPipelineError as exc:
             print(f"Apologies, we encountered a fatal pipeline error, and are stopping processing. The error is:\n{str(exc)}", file=stderr)
             self.retcode=1
 
+    def _merge_worker_stats(self, results):
+        for result, stats in results:
+            self._merge_stats(stats)
+            yield result
+
+    def _stages(self):
+        """This pipeline's steps, with runs of steps outside a Stage grouped into one"""
+        stages = []
+        for step in self.steps:
+            if isinstance(step, Stage):
+                stages.append(step)
+            elif stages and getattr(stages[-1], "_implicit", False):
+                stages[-1].add_step(step)
+            else:
+                stage = Stage(step)
+                stage._implicit = True
+                stages.append(stage)
+        return stages
+
+    def _process_staged(self, input_stream, max_inflight=None, ordered=True):
+        stages = self._stages()
+        for stage in stages:
+            stage.profile_memory = stage.profile_memory or self.profile_memory
+            if stage.profile_memory and stage.executor == "thread":
+                raise ValueError(f"profile_memory needs worker processes, but stage {stage.name} runs on threads")
+        if max_inflight is None:
+            max_inflight = 4 * sum(stage.workers for stage in stages)
+        runner = _StagedRun(stages, max_inflight)
+        try:
+            for file in runner.run(input_stream, ordered=ordered):
+                with _report_lock:
+                    self.report.record(file.instant, **file.report)
+                self.n += 1
+                yield file
+        except FatalPipelineError as exc:
+            print(f"Apologies, we encountered a fatal pipeline error, and are stopping processing. The error is:\n{str(exc)}", file=stderr)
+            self.retcode=1
+        finally:
+            runner.close()
+            self.stage_stats = runner.stats()
+            print_stage_stats(self.stage_stats)
+
     def __call__(self, *args, **kwargs):
         yield from self.process(*args, **kwargs)
 
-    def process_to(self, input_stream, output, ncpus=1):
-        for done in self.process(input_stream, ncpus=ncpus):
+    def process_to(self, input_stream, output, ncpus=1, **kwargs):
+        # Results are written from this thread. With worker processes, writing is handed to
+        # writer processes too; with threads (where pickling each result to another process
+        # would cost more than the write itself) it's done here, in a writer session.
+        if ncpus > 1 and kwargs.get("executor", "process") == "process" and hasattr(output, "parallel_writer"):
+            with output.parallel_writer(ncpus) as writer:
+                for done in self.process(input_stream, ncpus=ncpus, **kwargs):
+                    writer.write(done)
+            return
+        if hasattr(output, "writer"):
+            with output.writer():
+                for done in self.process(input_stream, ncpus=ncpus, **kwargs):
+                    output.write(done)
+            return
+        for done in self.process(input_stream, ncpus=ncpus, **kwargs):
             output.write(done)
 
     def write(self, file):
@@ -119,6 +528,269 @@ class TSPipeline(object):
                 self.report.merge(step.report)
                 step.report.close()
         self.report.close()
+        # Only pipelines that have been run (rather than used as a step) summarise timings
+        if self.n > 0:
+            print_step_timings(self.all_timings())
+            if self.profile_memory:
+                print_memory_profile(self.all_memory())
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+
+class Stage(TSPipeline):
+    """A group of steps that a stage-parallel TSPipeline runs on its own pool of workers.
+
+    Stages are connected by queues of at most `queue_size` files, so a slow stage holds
+    up those before it rather than letting files pile up. Each stage runs its steps on
+    `workers` threads, or with `executor="process"`, on a pool of `workers` processes.
+    For example, to read and write with I/O threads, decode on 8 processes, and write
+    bundles from a single thread:
+
+    ```
+    TSPipeline(
+        Stage(FileStatsStep(), workers=8),
+        Stage(DecodeImageFileStep(), ResizeImageStep(geom="720x"),
+              EncodeImageFileStep(format="jpg"), workers=8, executor="process"),
+        Stage(WriteFileStep(output), workers=1),
+    )
+    ```
+
+    Steps that aren't in a Stage each get a single-threaded stage.
+    """
+
+    def __init__(self, *steps, workers=1, executor="thread", queue_size=16, name=None):
+        super().__init__(*steps)
+        if executor not in ("process", "thread"):
+            raise ValueError(f"executor must be 'process' or 'thread', not {executor!r}")
+        self.workers = max(int(workers), 1)
+        self.executor = executor
+        self.queue_size = queue_size
+        self._name = name
+        self._implicit = False
+
+    @property
+    def name(self):
+        if self._name is not None:
+            return self._name
+        return "+".join(step.__class__.__name__ for step in self.steps)
+
+
+def _run_stage_in_worker(task):
+    if isinstance(task, dict):
+        task = TimestreamFile.from_descriptor(task)
+    file, aborted = _worker_pipeline._run_steps(task)
+    stats = _worker_pipeline._take_stats()
+    _worker_pipeline._clear_reports()
+    return file, aborted, stats
+
+
+class _StageStats(object):
+    def __init__(self):
+        self.lock = Lock()
+        self.files = 0
+        self.depth_total = 0
+        self.depth_max = 0
+        self.busy = 0.0
+
+    def update(self, depth, busy):
+        with self.lock:
+            self.files += 1
+            self.depth_total += depth
+            self.depth_max = max(self.depth_max, depth)
+            self.busy += busy
+
+
+class _StagedRun(object):
+    """Runs files through each stage's workers, connected by bounded queues.
+
+    Every stage has an input queue and `workers` threads taking from it. Thread stages
+    run their steps directly, process stages hand each file to their process pool and wait
+    for it. No more than `max_inflight` files are between the input and the output at once.
+    """
+
+    _DONE = object()
+
+    def __init__(self, stages, max_inflight):
+        self.stages = stages
+        self.queues = [queue.Queue(maxsize=max(stage.queue_size, 1)) for stage in stages]
+        self.output = queue.Queue()
+        self.slots = Semaphore(max(max_inflight, 1))
+        self.stop = Event()
+        self.pools = [None] * len(stages)
+        self._stats = [_StageStats() for _ in stages]
+        self._running = [stage.workers for stage in stages]
+        self._running_lock = Lock()
+        self._started = None
+        self._elapsed = None
+        self.threads = []
+
+    def _put(self, q, item):
+        # Blocks while q is full, which is how backpressure travels upstream
+        while not self.stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _feed(self, input_stream):
+        try:
+            for seq, file in enumerate(input_stream):
+                while not self.slots.acquire(timeout=0.1):
+                    if self.stop.is_set():
+                        return
+                if not self._put(self.queues[0], (seq, file)):
+                    return
+        except BaseException as exc:
+            self.output.put(("error", exc))
+            return
+        for _ in range(self.stages[0].workers):
+            self._put(self.queues[0], self._DONE)
+
+    def _forward(self, i, seq, file, aborted):
+        if aborted or i + 1 == len(self.stages):
+            self.output.put(("file", (seq, file)))
+        else:
+            self._put(self.queues[i + 1], (seq, file))
+
+    def _work(self, i):
+        stage, inq, stats = self.stages[i], self.queues[i], self._stats[i]
+        try:
+            while not self.stop.is_set():
+                try:
+                    item = inq.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if item is self._DONE:
+                    break
+                depth = inq.qsize()
+                seq, file = item
+                start = time.perf_counter()
+                if self.pools[i] is not None:
+                    file, aborted, worker_stats = self.pools[i].submit(_run_stage_in_worker, _worker_task(file)).result()
+                    stage._merge_stats(worker_stats)
+                else:
+                    file, aborted = stage._run_steps(file)
+                stats.update(depth, time.perf_counter() - start)
+                self._forward(i, seq, file, aborted)
+        except BaseException as exc:
+            self.output.put(("error", exc))
+            return
+        with self._running_lock:
+            self._running[i] -= 1
+            last = self._running[i] == 0
+        if last:
+            if i + 1 < len(self.stages):
+                for _ in range(self.stages[i + 1].workers):
+                    self._put(self.queues[i + 1], self._DONE)
+            else:
+                self.output.put(("done", None))
+
+    def _start(self, target, *args):
+        thread = Thread(target=target, args=args, daemon=True)
+        thread.start()
+        return thread
+
+    def run(self, input_stream, ordered=True):
+        self._started = time.perf_counter()
+        for i, stage in enumerate(self.stages):
+            if stage.executor == "process":
+                self.pools[i] = ProcessPoolExecutor(max_workers=stage.workers, initializer=_init_worker,
+                                                    initargs=(stage,))
+        for i, stage in enumerate(self.stages):
+            for _ in range(stage.workers):
+                self.threads.append(self._start(self._work, i))
+        # not joined on close(), as it may be blocked on the input (e.g. waiting for inotify)
+        self._start(self._feed, input_stream)
+
+        waiting = {}
+        nextseq = 0
+        while True:
+            kind, value = self.output.get()
+            if kind == "error":
+                raise value
+            if kind == "done":
+                break
+            seq, file = value
+            if not ordered:
+                self.slots.release()
+                yield file
+                continue
+            waiting[seq] = file
+            while nextseq in waiting:
+                self.slots.release()
+                yield waiting.pop(nextseq)
+                nextseq += 1
+        for seq in sorted(waiting):
+            yield waiting[seq]
+
+    def close(self):
+        self.stop.set()
+        if self._started is not None and self._elapsed is None:
+            self._elapsed = time.perf_counter() - self._started
+        for thread in self.threads:
+            thread.join()
+        for pool in self.pools:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+
+    def stats(self):
+        """Per-stage statistics: how deep its input queue was, and how busy its workers were"""
+        elapsed = self._elapsed or 0.0
+        stats = []
+        for stage, st in zip(self.stages, self._stats):
+            stats.append({
+                "Stage": stage.name,
+                "Workers": stage.workers,
+                "Executor": stage.executor,
+                "Files": st.files,
+                "MeanQueueDepth": st.depth_total / st.files if st.files else 0.0,
+                "MaxQueueDepth": st.depth_max,
+                "QueueSize": stage.queue_size,
+                "Busy": st.busy / (stage.workers * elapsed) if elapsed > 0 else 0.0,
+            })
+        return stats
+
+
+def print_stage_stats(stats, file=stderr):
+    """Print per-stage statistics of a stage-parallel run as a table.
+
+    A stage whose input queue is usually full, while the stages after it have empty
+    queues, is the bottleneck.
+    """
+    print("\nStage\tWorkers\tFiles\tMeanQueue\tMaxQueue\tBusy", file=file)
+    for st in stats:
+        print(f"{st['Stage']}\t{st['Workers']} x {st['Executor']}\t{st['Files']}\t"
+              f"{st['MeanQueueDepth']:.1f}\t{st['MaxQueueDepth']}/{st['QueueSize']}\t"
+              f"{100 * st['Busy']:.0f}%", file=file)
+
+
+def print_step_timings(timings, file=stderr):
+    """Print step timings, as from `TSPipeline.all_timings()`, as a table"""
+    if not timings:
+        return
+    total = sum(values[1] for name, values in timings.items() if "/" not in name) or 1.0
+    print("\nStep\tCalls\tWall(s)\tCPU(s)\tms/call\t%Wall\tMBIn\tMBOut", file=file)
+    for name, (calls, wall, cpu, nin, nout) in timings.items():
+        percall = 1000 * wall / calls if calls else 0.0
+        print(f"{name}\t{calls}\t{wall:.2f}\t{cpu:.2f}\t{percall:.1f}\t{100 * wall / total:.0f}%\t"
+              f"{nin / 1024**2:.1f}\t{nout / 1024**2:.1f}", file=file)
+
+
+def print_memory_profile(memory, file=stderr):
+    """Print a `MemoryProfile` as tables of per-step growth and of the worst files"""
+    if not memory.rows:
+        return
+    mb = 1024**2
+    print("\nStep\tCalls\tMaxPeakMB\tMeanRSSGrowthMB\tMaxRSSGrowthMB", file=file)
+    for name, (calls, peak, growth, maxgrowth) in memory.rows.items():
+        print(f"{name}\t{calls}\t{peak / mb:.1f}\t{growth / calls / mb:.1f}\t{maxgrowth / mb:.1f}", file=file)
+    print("\nFile\tStep\tPeakMB", file=file)
+    for peak, filename, name in sorted(memory.worst, reverse=True):
+        print(f"{filename}\t{name}\t{peak / mb:.1f}", file=file)
+    print(f"\nLargest worker footprint (RSS): {memory.max_rss / mb:.0f} MB", file=file)
 
 
 class ResultRecorder(object):
@@ -195,8 +867,13 @@ class PipelineStep(object):
 
     All pipeline steps should implement a method called `process_file` that accepts one
     argument `file`, and returns either TimestreamFile or a subclass of it.
+
+    Steps that mostly wait on disk or network (writing, deleting, sending metrics) should
+    set `io_bound = True`, so that schedulers can run them apart from compute-heavy steps.
     """
 
+    io_bound = False
+
     def process_file(self, file):
         return file
 
@@ -241,6 +918,8 @@ class TeeStep(PipelineStep):
 class WriteFileStep(PipelineStep):
     """Write each file to output, without changing the file"""
 
+    io_bound = True
+
     def __init__(self, output):
         self.output = output
 
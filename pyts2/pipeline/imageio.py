@@ -61,7 +61,13 @@ class DecodeImageFileStep(PipelineStep):
         base, ext = op.splitext(file.filename)
         format = ext.lower().strip(".")
         if format in ("cr2", "nef", "rw2"):
-            with rawpy.imread(io.BytesIO(file.content)) as img:
+            if file._content is None and isinstance(file.fetcher, FileContentFetcher):
+                # libraw reads files on disk itself
+                source = str(file.fetcher.pathondisk)
+            else:
+                # rawpy reads file objects into bytes, which BytesIO hands over without a copy
+                source = io.BytesIO(file.content)
+            with rawpy.imread(source) as img:
                 if self.process_raws:
                     pixels = img.postprocess(**self.decode_options[format].copy())
                 elif self.raw_use_embedded_jpeg:
@@ -74,7 +80,7 @@ class DecodeImageFileStep(PipelineStep):
                 else:
                     pixels = img.raw_image.copy()
         else:
-            pixels = imageio.imread(file.content)
+            pixels = imageio.imread(file.content_view)
         return TimestreamImage.from_timestreamfile(file, pixels=pixels)
 
 
@@ -210,7 +216,8 @@ class TimestreamImage(TimestreamFile):
             "filename": file.filename,
             "fetcher": file.fetcher,
             "report": file.report,
-            "content": file.content,
+            # don't force a read of content here, it's fetched again if needed
+            "content": file._content,
         }
         params.update(kwargs)
         return cls(**params)
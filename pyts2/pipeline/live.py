@@ -0,0 +1,91 @@
+# Copyright (c) 2018 Kevin Murray <kdmfoss@gmail.com>
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from sys import stderr
+from threading import Thread
+
+from .base import FatalPipelineError, _report_lock
+
+
+class AsyncPipelineRunner(object):
+    """Drives a TSPipeline from an asyncio event loop, for live (e.g. inotify) input.
+
+    Files from the (blocking) input iterator are read on a thread and fed to a queue of at
+    most `max_inflight` files, which that many tasks take from. Each task runs the
+    pipeline's steps on one file, in order: steps with `io_bound` set (writes, deletes,
+    metric sends) on a pool of `io_threads` threads, all other steps on a pool of `ncpus`
+    threads. So while one file is being decoded or scanned, others are being written and
+    reported, and a burst of files is worked through `max_inflight` at a time.
+    """
+
+    def __init__(self, pipeline, ncpus=1, io_threads=8, max_inflight=None):
+        self.pipe = pipeline
+        self.ncpus = max(ncpus, 1)
+        self.io_threads = max(io_threads, 1)
+        if max_inflight is None:
+            max_inflight = 2 * (self.ncpus + self.io_threads)
+        self.max_inflight = max(max_inflight, 1)
+
+    async def process_file(self, file):
+        loop = asyncio.get_running_loop()
+        for i, step in enumerate(self.pipe.steps):
+            pool = self._io_pool if getattr(step, "io_bound", False) else self._cpu_pool
+            file, aborted = await loop.run_in_executor(pool, self.pipe._run_step, i, file)
+            if aborted:
+                break
+        with _report_lock:
+            self.pipe.report.record(file.instant, **file.report)
+        return file
+
+    def _feed(self, loop, input_stream, queue):
+        def put(item):
+            asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+        try:
+            for file in input_stream:
+                put(file)
+        except BaseException as exc:
+            put(exc)
+            return
+        for _ in range(self.max_inflight):
+            put(None)
+
+    async def _work(self, queue, on_done):
+        while True:
+            file = await queue.get()
+            if file is None:
+                return
+            if isinstance(file, BaseException):
+                raise file
+            file = await self.process_file(file)
+            self.pipe.n += 1
+            if on_done is not None:
+                on_done(file)
+
+    async def arun(self, input_stream, on_done=None):
+        """Process every file of `input_stream`, calling `on_done(file)` as each finishes"""
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=self.max_inflight)
+        self._cpu_pool = ThreadPoolExecutor(max_workers=self.ncpus)
+        self._io_pool = ThreadPoolExecutor(max_workers=self.io_threads)
+        # daemonic, as reading from inotify never finishes
+        Thread(target=self._feed, args=(loop, input_stream, queue), daemon=True).start()
+        workers = [asyncio.create_task(self._work(queue, on_done)) for _ in range(self.max_inflight)]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+            self._cpu_pool.shutdown()
+            self._io_pool.shutdown()
+
+    def run(self, input_stream, on_done=None):
+        try:
+            asyncio.run(self.arun(input_stream, on_done=on_done))
+        except FatalPipelineError as exc:
+            print(f"Apologies, we encountered a fatal pipeline error, and are stopping processing. The error is:\n{str(exc)}", file=stderr)
+            self.pipe.retcode = 1
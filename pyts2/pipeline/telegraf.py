@@ -12,6 +12,8 @@ import pytz
 class TelegrafRecordStep(PipelineStep):
     """Write each file to output, without changing the file"""
 
+    io_bound = True
+
     def __init__(self, metric_name, telegraf_host='localhost', telegraf_port=8092, tags={}, tz=None):
         self.client = TelegrafClient(host=telegraf_host, port=telegraf_port)
         self.metric_name = metric_name
@@ -9,6 +9,8 @@ from ..timestream import FileContentFetcher
 
 class UnsafeNuker(PipelineStep):
 
+    io_bound = True
+
     def process_file(self, file):
         if not isinstance(file.fetcher, FileContentFetcher):
             print(f"WARNING: can't delete {file.filename} as it is bundled", file=stderr)
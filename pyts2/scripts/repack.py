@@ -0,0 +1,88 @@
+# Copyright (c) 2018-2020 Kevin Murray <foss@kdmurray.id.au>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+from os import path as op
+from sys import stderr
+from tqdm import tqdm
+import zipfile
+
+from pyts2.filelock import FileLock
+from pyts2.time import extract_datetime
+from pyts2.timestream import TimeStream, archive_pool, zip_member_is_stored, zip_member_data_offset
+
+
+def find_zips(path):
+    if op.isfile(path):
+        if zipfile.is_zipfile(path):
+            yield path
+        return
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for file in sorted(files):
+            if file.lower().endswith(".zip"):
+                yield op.join(root, file)
+
+
+def repack_zip(path):
+    """Rewrite the zip bundle at `path` in instant order, without duplicated members.
+
+    Where a name occurs more than once, the last copy (the one readers see) is kept.
+    Stored members are copied byte-for-byte from a view of the old archive; compressed
+    members are re-compressed with their original method.
+
+    Returns the number of members kept and dropped.
+    """
+    tmppath = f"{path}.repack"
+    with FileLock(path):
+        with zipfile.ZipFile(path) as src:
+            members = {}
+            for info in src.infolist():
+                if info.is_dir():
+                    continue
+                if info.filename in members:
+                    if members[info.filename].CRC != info.CRC:
+                        print(f"WARNING: {path} has differing copies of {info.filename}, keeping the last",
+                              file=stderr)
+                members[info.filename] = info
+            ndropped = len(src.infolist()) - len(members)
+            order = sorted(members.values(),
+                           key=lambda info: (extract_datetime(op.basename(info.filename)), info.filename))
+            with zipfile.ZipFile(tmppath, mode="w", compression=zipfile.ZIP_STORED, allowZip64=True) as dst:
+                for info in order:
+                    newinfo = zipfile.ZipInfo(info.filename, date_time=info.date_time)
+                    newinfo.compress_type = info.compress_type
+                    newinfo.external_attr = info.external_attr
+                    if zip_member_is_stored(info):
+                        offset = zip_member_data_offset(src, info)
+                        data = archive_pool.view(path, offset, info.file_size)
+                    else:
+                        data = src.read(info)
+                    dst.writestr(newinfo, data)
+        os.replace(tmppath, path)
+    return len(members), ndropped
+
+
+def repack_main(input, output=None, bundle=None, informat=None):
+    """
+    input: TimeStream whose zip bundles are to be repacked
+    output: If given, write a re-bundled copy of input here instead of rewriting in place
+    bundle: Bundle level of output
+    informat: Only repack files of this format (only with output)
+    """
+    if output is not None:
+        outts = TimeStream(output, bundle_level=bundle)
+        # Iteration is in instant order, and writes skip files already present
+        with outts.writer():
+            for file in tqdm(TimeStream(input, format=informat), unit=" files"):
+                outts.write(file)
+        return
+    nkept = ndropped = 0
+    for path in tqdm(list(find_zips(input)), unit=" bundles"):
+        kept, dropped = repack_zip(path)
+        nkept += kept
+        ndropped += dropped
+    print(f"Repacked {nkept} files, removed {ndropped} duplicates", file=stderr)
@@ -3,8 +3,12 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import numpy as np
 from tqdm import tqdm
 
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
 import copy
 import datetime as dt
 import hashlib
@@ -12,12 +16,16 @@ import io
 import os
 import os.path as op
 import json
+import mmap
 from pathlib import Path
+import queue
 from queue import Queue
 import re
+import struct
 from sys import stderr, stdout, stdin
 import tarfile
-from threading import Thread
+from threading import Thread, Lock, RLock
+import time
 import traceback
 import warnings
 import zipfile
@@ -25,7 +33,7 @@ import zlib
 
 from pyts2.time import *
 from pyts2.utils import *
-from pyts2.filelock import FileLock
+from pyts2.filelock import FileLock, FileLockException
 
 
 def path_is_timestream_file(path, extensions=None):
@@ -71,18 +79,288 @@ def path_is_timestream_file(path, extensions=None):
         return False
 
 
+MAX_OPEN_ARCHIVES = int(os.environ.get("TSTK_MAX_OPEN_ARCHIVES", 64))
+
+
+class TarMember(object):
+    """Location of a member's header and data within an uncompressed tar archive"""
+    __slots__ = ("offset_header", "offset_data", "size")
+
+    def __init__(self, offset_header, offset_data, size):
+        self.offset_header = offset_header
+        self.offset_data = offset_data
+        self.size = size
+
+    @classmethod
+    def from_tarinfo(cls, tarinfo):
+        if not tarinfo.isfile() or tarinfo.issparse():
+            # sparse members aren't stored contiguously, so can't be read by offset
+            return None
+        return cls(tarinfo.offset, tarinfo.offset_data, tarinfo.size)
+
+
+class _PooledArchive(object):
+    def __init__(self, stat):
+        self.stat = stat
+        # the archive's open handles by kind (zip/tar, raw file, mmap), opened as needed
+        self.handles = {}
+        # ZipFile and TarFile objects have one file position, so only one user at a time
+        self.lock = Lock()
+        # held while opening a handle, so the pool's lock isn't held while a slow open runs
+        self.open_lock = Lock()
+        # users holding this entry, and whether it's left the pool (both under the pool lock)
+        self.pins = 0
+        self.evicted = False
+        self.members = None
+
+    def add(self, kind, handle):
+        if isinstance(handle, tarfile.TarFile):
+            self.members = {m.name: TarMember.from_tarinfo(m) for m in handle.getmembers()}
+        # published last, so whoever sees the handle also sees the members
+        self.handles[kind] = handle
+
+
+class ArchiveHandlePool(object):
+    """A process-wide LRU cache of open zip and tar archive handles.
+
+    Opening an archive means parsing the zip central directory or scanning every tar
+    header, so fetchers share handles here rather than re-opening the archive for each
+    member. At most `max_open` archives are kept open (counting an archive's handle,
+    raw file and memory map as one); the least recently used is closed when that budget is
+    exceeded. Handles are re-opened if the archive's size or mtime
+    changes (e.g. a bundle that has been appended to since we opened it).
+
+    Entries are pinned while in use, so a handle that is evicted while someone is reading
+    from it is only closed once they're done.
+    """
+
+    def __init__(self, max_open=MAX_OPEN_ARCHIVES):
+        self.max_open = max_open
+        self._reset()
+        if hasattr(os, "register_at_fork"):
+            # Children must not share file positions with their parent's handles
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._handles = OrderedDict()
+        self._lock = RLock()
+
+    @staticmethod
+    def _open(path, kind):
+        if kind == "zip":
+            return zipfile.ZipFile(path)
+        elif kind == "tar":
+            return tarfile.TarFile(path)
+        elif kind == "raw":
+            return open(path, "rb")
+        elif kind == "mmap":
+            return _mmap_file(path)
+        raise ValueError(f"Unknown archive type {kind}")
+
+    @staticmethod
+    def _close(entry):
+        # only called once nobody has the entry pinned
+        for handle in entry.handles.values():
+            if isinstance(handle, mmap.mmap):
+                # memoryviews handed out may still reference this, it's unmapped once they're gone
+                continue
+            handle.close()
+
+    @staticmethod
+    def _evict(entries):
+        # With the pool lock held: mark entries as gone, and return those that can be closed now
+        closable = []
+        for entry in entries:
+            entry.evicted = True
+            if entry.pins == 0:
+                closable.append(entry)
+        return closable
+
+    def _get(self, path, kind):
+        """The pooled entry for `path`, pinned until it is given back with `_release()`"""
+        st = os.stat(path)
+        stat = (st.st_size, st.st_mtime_ns)
+        evicted = []
+        with self._lock:
+            entry = self._handles.get(path)
+            if entry is not None and entry.stat != stat:
+                evicted.append(self._handles.pop(path))
+                entry = None
+            if entry is None:
+                entry = _PooledArchive(stat)
+                self._handles[path] = entry
+                while len(self._handles) > max(self.max_open, 1):
+                    evicted.append(self._handles.popitem(last=False)[1])
+            self._handles.move_to_end(path)
+            entry.pins += 1
+            closable = self._evict(evicted)
+        for old in closable:
+            self._close(old)
+        if kind not in entry.handles:
+            # Opening (and for tars, scanning every header) can be slow, so it's done outside
+            # the pool lock: only users of this archive wait for it
+            try:
+                with entry.open_lock:
+                    if kind not in entry.handles:
+                        entry.add(kind, self._open(path, kind))
+            except BaseException:
+                self._release(entry)
+                raise
+        return entry
+
+    def _release(self, entry):
+        with self._lock:
+            entry.pins -= 1
+            close = entry.evicted and entry.pins == 0
+        if close:
+            self._close(entry)
+
+    @contextmanager
+    def _pinned(self, path, kind):
+        entry = self._get(op.abspath(str(path)), kind)
+        try:
+            yield entry
+        finally:
+            self._release(entry)
+
+    @contextmanager
+    def open(self, path, kind):
+        """Context manager giving exclusive use of the pooled handle for `path`"""
+        with self._pinned(path, kind) as entry:
+            with entry.lock:
+                yield entry.handles[kind]
+
+    def tar_member(self, path, name):
+        """Look up `name` in the tar member index of `path`, scanning the tar if needed"""
+        with self._pinned(path, "tar") as entry:
+            return entry.members.get(name)
+
+    def pread(self, path, offset, size):
+        """Read `size` bytes at `offset` of `path` without scanning it as an archive"""
+        with self._pinned(path, "raw") as entry:
+            # pread doesn't use the file position, so there's no need for the entry's lock
+            return os.pread(entry.handles["raw"].fileno(), size, offset)
+
+    def view(self, path, offset, size):
+        """A zero-copy memoryview of `size` bytes at `offset` of `path`"""
+        with self._pinned(path, "mmap") as entry:
+            return memoryview(entry.handles["mmap"])[offset:offset+size]
+
+    def close(self, path=None):
+        """Close all pooled handles, or only those for `path`"""
+        with self._lock:
+            evicted = [self._handles.pop(key) for key in list(self._handles)
+                       if path is None or key == op.abspath(str(path))]
+            closable = self._evict(evicted)
+        for entry in closable:
+            self._close(entry)
+
+    def __len__(self):
+        return len(self._handles)
+
+
+archive_pool = ArchiveHandlePool()
+
+
+def _mmap_file(path):
+    with open(path, "rb") as fh:
+        if os.fstat(fh.fileno()).st_size == 0:
+            return b''  # can't mmap an empty file
+        return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+ZIP_LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+
+
+def zip_member_is_stored(info):
+    """True if a zip member's bytes in the archive are its contents (i.e. not compressed/encrypted)"""
+    return info.compress_type == zipfile.ZIP_STORED and not info.flag_bits & 0x1
+
+
+def zip_member_data_offset(zfh, info):
+    """Offset of a member's data within the archive of an open ZipFile"""
+    # the local header's name & extra field lengths can differ from the central
+    # directory's, so we have to read it to find where the data starts
+    zfh.fp.seek(info.header_offset)
+    header = ZIP_LOCAL_HEADER.unpack(zfh.fp.read(ZIP_LOCAL_HEADER.size))
+    if header[0] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile(f"Bad local header for {info.filename} in {zfh.filename}")
+    return info.header_offset + ZIP_LOCAL_HEADER.size + header[-2] + header[-1]
+
+
+class TimestreamFileMatcher(object):
+    """A precompiled equivalent of `path_is_timestream_file(path, extensions)`
+
+    >>> is_tsfile = TimestreamFileMatcher("jpg")
+    >>> is_tsfile("test_2018_12_31_23_59_59_00.JPEG")
+    True
+    >>> is_tsfile("test_2018_12_31_23_59_59_00.tif")
+    False
+    """
+
+    def __init__(self, extensions=None):
+        if extensions is None:
+            extensions = []
+        if isinstance(extensions, str):
+            extensions = [extensions, ]
+        extensions = set(extensions)
+        for a, b in [("tif", "tiff"), ("jpg", "jpeg")]:
+            if a in extensions or b in extensions:
+                extensions.update((a, b))
+        self.ext_re = None
+        if extensions:
+            exts = "|".join(re.escape(ext.lower()) for ext in sorted(extensions))
+            self.ext_re = re.compile(r"\.(?:" + exts + r")$")
+
+    def __call__(self, path):
+        if TS_DATETIME_RE.search(path) is None:
+            return False
+        return self.ext_re is None or self.ext_re.search(path.lower()) is not None
+
+
+# Files with these extensions are never sniffed to see if they're archives
+NOT_ARCHIVE_EXTENSIONS = {
+    ".jpg", ".jpeg", ".tif", ".tiff", ".png", ".cr2", ".nef", ".rw2", ".dng", ".orf", ".raw",
+    ".json", ".lock", ".tsidx", ".delta", ".tsv", ".csv", ".txt", ".log", ".md", ".sh", ".xml",
+}
+
+
+def sniff_archive_type(path):
+    """Returns "zip" or "tar" if the magic bytes of `path` say it's one of these, or None"""
+    try:
+        with open(path, "rb") as fh:
+            head = fh.read(512)
+    except OSError:
+        return None
+    if head[:4] in (b"PK\x03\x04", b"PK\x05\x06"):
+        return "zip"
+    if head[257:262] == b"ustar":
+        return "tar"
+    return None
+
+
 class Fetcher(object):
     @classmethod
     def from_json(self, obj):
         if obj["type"] == "zip":
             return ZipContentFetcher(obj["archivepath"], obj["pathinzip"])
         elif obj["type"] == "tar":
-            return TarContentFetcher(obj["archivepath"], obj["pathintar"])
+            member = None
+            if obj.get("offset_data") is not None:
+                member = TarMember(obj["offset_header"], obj["offset_data"], obj["size"])
+            return TarContentFetcher(obj["archivepath"], obj["pathintar"], member=member)
+        elif obj["type"] == "file":
+            return FileContentFetcher(obj["path"])
+        raise ValueError(f"Unknown fetcher type {obj['type']}")
 
     @property
     def instant(self):
         return TSInstant.from_path(self.filename)
 
+    def getview(self):
+        """Get contents as a memoryview, without copying where the storage allows"""
+        return memoryview(self.get())
+
 
 class ZipContentFetcher(Fetcher):
     _fetchtype = 'zip'
@@ -92,9 +370,17 @@ class ZipContentFetcher(Fetcher):
         self.pathinzip = pathinzip
 
     def get(self):
-        with zipfile.ZipFile(str(self.archivepath)) as zfh:
+        with archive_pool.open(self.archivepath, "zip") as zfh:
             return zfh.read(self.pathinzip)
 
+    def getview(self):
+        with archive_pool.open(self.archivepath, "zip") as zfh:
+            info = zfh.getinfo(self.pathinzip)
+            if not zip_member_is_stored(info):
+                return memoryview(zfh.read(info))
+            offset = zip_member_data_offset(zfh, info)
+        return archive_pool.view(self.archivepath, offset, info.file_size)
+
     @property
     def filename(self):
         return op.basename(self.pathinzip)
@@ -108,22 +394,40 @@ class ZipContentFetcher(Fetcher):
 class TarContentFetcher(Fetcher):
     _fetchtype = 'tar'
 
-    def __init__(self, archivepath, pathintar):
+    def __init__(self, archivepath, pathintar, member=None):
         self.archivepath = archivepath
         self.pathintar = pathintar
+        self.member = member
 
     def get(self):
-        with tarfile.TarFile(self.archivepath) as tfh:
-            return tfh.extractfile(self.pathintar).read()
+        if self.member is None:
+            self.member = archive_pool.tar_member(self.archivepath, self.pathintar)
+        if self.member is None:
+            # not a plain file member (e.g. sparse), so let tarfile deal with it
+            with archive_pool.open(self.archivepath, "tar") as tfh:
+                return tfh.extractfile(self.pathintar).read()
+        return archive_pool.pread(self.archivepath, self.member.offset_data, self.member.size)
+
+    def getview(self):
+        if self.member is None:
+            self.member = archive_pool.tar_member(self.archivepath, self.pathintar)
+        if self.member is None:
+            return memoryview(self.get())
+        return archive_pool.view(self.archivepath, self.member.offset_data, self.member.size)
 
     @property
     def filename(self):
         return op.basename(self.pathintar)
 
     def dict(self):
-        return {"type": "tar",
-                "archivepath": self.archivepath,
-                "pathintar": self.pathintar}
+        d = {"type": "tar",
+             "archivepath": self.archivepath,
+             "pathintar": self.pathintar}
+        if self.member is not None:
+            d.update({"offset_header": self.member.offset_header,
+                      "offset_data": self.member.offset_data,
+                      "size": self.member.size})
+        return d
 
 
 class FileContentFetcher(Fetcher):
@@ -134,6 +438,10 @@ class FileContentFetcher(Fetcher):
         with open(self.pathondisk, "rb") as fh:
             return fh.read()
 
+    def getview(self):
+        # Not pooled, the mapping lives as long as the returned view
+        return memoryview(_mmap_file(self.pathondisk))
+
     @property
     def filename(self):
         return op.basename(self.pathondisk)
@@ -177,6 +485,19 @@ class TimestreamFile(object):
             self._content = b''
         return self._content
 
+    @property
+    def content_view(self):
+        """File contents as a read-only memoryview.
+
+        Unlike `content`, this doesn't copy or cache the bytes: where possible it is a view
+        of a memory map of the file (or of the member's data within a stored zip or tar).
+        """
+        if self._content is None and self.fetcher is not None:
+            return self.fetcher.getview()
+        if self._content is None:
+            return memoryview(b'')
+        return memoryview(self._content)
+
     def clear_content(self):
         del self._content
         self._content = None
@@ -206,6 +527,30 @@ class TimestreamFile(object):
             instant = TSInstant.from_path(filename)
         return cls(content=filebytes, filename=filename, instant=instant)
 
+    def descriptor(self):
+        """A small, picklable description of this file, see `from_descriptor()`.
+
+        Content that can be re-read through the fetcher is left out, so a file from a
+        timestream is described in a few hundred bytes.
+        """
+        desc = {"instant": self.instant,
+                "filename": self.filename,
+                "format": self.format,
+                "report": self.report}
+        if self.fetcher is not None:
+            desc["fetcher"] = self.fetcher.dict()
+        else:
+            desc["content"] = self.content
+        return desc
+
+    @classmethod
+    def from_descriptor(cls, desc):
+        fetcher = desc.get("fetcher")
+        if fetcher is not None:
+            fetcher = Fetcher.from_json(fetcher)
+        return cls(instant=desc["instant"], filename=desc["filename"], fetcher=fetcher,
+                   content=desc.get("content"), report=desc["report"], format=desc["format"])
+
     def isodate(self):
         """convenience helper to get iso8601 string"""
         return self.instant.isodate("%Y-%m-%dT%H:%M:%S")
@@ -215,7 +560,7 @@ class TimestreamFile(object):
 
     def checksum(self, algorithm="md5"):
         hasher = hashlib.new(algorithm)
-        hasher.update(self.content)
+        hasher.update(self.content_view)
         return hasher.hexdigest()
 
     def __repr__(self):
@@ -230,16 +575,52 @@ class TimestreamFile(object):
         return self.checksum('sha512')
 
 
+# Directory names in the %Y/%Y_%m/%Y_%m_%d/%Y_%m_%d_%H layout
+TS_DIR_RE = re.compile(r"^(?:19|20)\d\d(?:_\d\d){0,3}$")
+SCAN_THREADS = int(os.environ.get("TSTK_SCAN_THREADS", 8))
+
+
+def _listdir(top):
+    """Returns (sorted subdirectory names, DirEntries of files sorted by timestamp, mtime) of `top`"""
+    # stat first, so that anything added while listing makes the recorded mtime stale
+    mtime = os.stat(top).st_mtime_ns
+    with os.scandir(top) as it:
+        entries = list(it)
+    dirs = []
+    files = []
+    for entry in entries:
+        if entry.name.startswith("."):
+            continue
+        if entry.is_dir():
+            if not entry.is_symlink():  # as os.walk, don't follow links to dirs
+                dirs.append(entry.name)
+        else:
+            files.append(entry)
+    # ensure sorted iteration
+    dirs.sort()
+    files.sort(key=lambda entry: extract_datetime(entry.name))
+    return dirs, files, mtime
+
+
+def _settled_mtime(mtime_ns):
+    """`mtime_ns`, or -1 if it's so recent that a further change might not alter it"""
+    # like git's "racily clean" check: timestamps are coarse, so record very recent ones
+    # as unknown, forcing a recheck next time
+    if time.time_ns() - mtime_ns < 2 * 10**9:
+        return -1
+    return mtime_ns
+
+
 class TimeStream(object):
     bundle_levels = ("root", "year", "month", "day", "hour", "none")
 
     def __init__(self, path=None, format=None, onerror="warn",
                  bundle_level="none", name=None, timefilter=None,
                  add_subsecond_field=False, flat_output=False,
-                 write_index=False):
+                 write_index=False, scan_threads=None):
         """path is the base directory of a timestream"""
-        self._files = {}
-        self._instants = {}
+        self._index = None
+        self._scan_record = None
         self.name = name
         self.path = None
         if format is not None:
@@ -249,7 +630,11 @@ class TimeStream(object):
             if format == "jpeg":
                 format = "jpg"
         self.format = format
+        self._is_timestream_file = TimestreamFileMatcher(format)
         self.sorted = True
+        if scan_threads is None:
+            scan_threads = SCAN_THREADS
+        self.scan_threads = scan_threads
         self.write_index = write_index
         self.add_subsecond_field = add_subsecond_field
         self.flat_output = flat_output
@@ -264,12 +649,18 @@ class TimeStream(object):
         else:
             raise ValueError("onerror should be one of raise, skip, or warn")
         self._index_file = None
+        self._json_index_file = None
+        self._index_delta_file = None
+        self._writer = None
         if path is not None:
             self.open(path, format=format)
             if bundle_level == "root" or op.isfile(self.path):
-                self._index_file = self.path + ".index.json"
+                self._index_file = self.path + ".index.tsidx"
+                self._json_index_file = self.path + ".index.json"
             else:
-                self._index_file = op.join(self.path, "index.json")
+                self._index_file = op.join(self.path, "index.tsidx")
+                self._json_index_file = op.join(self.path, "index.json")
+            self._index_delta_file = self._index_file + ".delta"
 
     def open(self, path, format=None):
         if self.name is None:
@@ -280,79 +671,337 @@ class TimeStream(object):
         self.path = path
 
     def index(self, progress=True):
-        if len(self._instants) == 0 or len(self._files) == 0:
-            with FileLock(self._index_file, timeout=3600):
-                pass
+        """Load (or if needed, build) the index of this timestream's files.
+
+        See pyts2.index.TimeStreamIndex. Files written since the index was saved are
+        merged in from its delta log (see `_log_written()`), and any other changes found
+        by `_refresh_index()`. Indices in the older, json lines format are still read. An index is only created if write_index is set, and never for a
+        stream with a timefilter, as such an index would be incomplete.
+        """
+        from pyts2.index import TimeStreamIndex
+        if self._index is not None:
+            return
+        with FileLock(self._index_file, timeout=3600):
+            pass
+        try:
+            if op.exists(self._index_file):
+                print("read index", self._index_file, file=stderr)
+                index = self._apply_index_delta(TimeStreamIndex.load(self._index_file))
+                self._index = self._refresh_index(index)
+            elif op.exists(self._json_index_file):
+                print("read index", self._json_index_file, file=stderr)
+                with open(self._json_index_file, "r") as fh:
+                    self._index = TimeStreamIndex.build(Fetcher.from_json(json.loads(line)) for line in tqdm(fh))
+            if self._index is not None and len(self._index) > 0:
+                return
+        except Exception as exc:
+            print("Failed to load index file:", str(exc), file=stderr)
+            if stderr.isatty():
+                traceback.print_exc(file=stderr)
+        with FileLock(self._index_file):
             try:
-                if op.exists(self._index_file):  # TODO FIXME make this check if the index is stale
-                    print("read index", self._index_file, file=stderr)
-                    with open(self._index_file, "r") as fh:
-                        self._files = {}
-                        self._instants = {}
-                        for line in tqdm(fh):
-                            fetcher = Fetcher.from_json(json.loads(line))
-                            self._files[fetcher.filename] = fetcher
-                            self._instants[fetcher.instant] = fetcher
-                        if len(self._instants) > 0 and len(self._files) > 0:
-                            return
+                self._scan_record = {"dirs": {}, "archives": {}}
+                itr = self.iter(tar_contents=False)
+                if progress:
+                    itr = tqdm(itr)
+                self._index = TimeStreamIndex.build((f.fetcher for f in itr), meta=self._scan_record)
+                if self.write_index and self.timefilter is None:
+                    self._index.save(self._index_file)
             except Exception as exc:
-                print("Failed to load index file:", str(exc), file=stderr)
+                print("Failed to create timestream index file:", str(exc), file=stderr)
                 if stderr.isatty():
                     traceback.print_exc(file=stderr)
-            with FileLock(self._index_file):
+                if op.exists(self._index_file):
+                    os.unlink(self._index_file)
+            finally:
+                self._scan_record = None
+
+    def _apply_index_delta(self, index):
+        """Merge the files logged by writers since the index was saved, and save the result"""
+        from pyts2.index import TimeStreamIndex
+        if not op.exists(self._index_delta_file):
+            return index
+        with FileLock(self._index_file):
+            try:
+                with open(self._index_delta_file) as fh:
+                    lines = fh.readlines()
+            except FileNotFoundError:
+                return index  # already merged by someone else
+            # reload under the lock, as another reader may have merged an earlier delta
+            index = TimeStreamIndex.load(self._index_file)
+            fetchers = []
+            meta = copy.deepcopy(index.meta)
+            for line in lines:
                 try:
-                    itr = self.iter(tar_contents=False)
-                    if progress:
-                        itr = tqdm(itr)
-                    if self.write_index:
-                        with open(self._index_file, "w") as fh:
-                            for f in itr:
-                                self._instants[f.instant] = f.fetcher
-                                print(json.dumps(f.fetcher.dict(), cls=PathAwareJsonEncoder), file=fh)
-                    else:
-                        for f in itr:
-                            self._instants[f.instant] = f.fetcher
-                except Exception as exc:
-                    print("Failed to create timestream index file:", str(exc), file=stderr)
-                    if stderr.isatty():
-                        traceback.print_exc(file=stderr)
-                    if op.exists(self._index_file):
-                        os.unlink(self._index_file)
+                    delta = json.loads(line)
+                except ValueError:
+                    continue  # a partial line from an interrupted writer
+                fetchers.extend(Fetcher.from_json(f) for f in delta["files"])
+                for key in ("dirs", "archives"):
+                    if key in meta:
+                        meta[key].update(delta[key])
+            index = index.merge(None, TimeStreamIndex.build(fetchers), meta=meta)
+            try:
+                index.save(self._index_file)
+                os.unlink(self._index_delta_file)
+            except OSError as exc:
+                print("Failed to save merged timestream index:", str(exc), file=stderr)
+        return index
+
+    def _log_written(self, fetchers, dirs=(), archives=None):
+        """Log just-written files to the index's delta file, to be merged by `index()`.
+
+        `dirs` are the directories written to, and `archives` maps the bundles written to
+        to their stat after writing, so that the next `index()` doesn't find them stale.
+        Nothing is logged if the stream has no saved index.
+        """
+        if self._index_file is None or not op.exists(self._index_file):
+            return
+        if archives is None:
+            archives = {}
+        delta = {
+            "files": [fetcher.dict() for fetcher in fetchers],
+            "dirs": {op.normpath(dir): _settled_mtime(os.stat(dir).st_mtime_ns) for dir in dirs},
+            "archives": {op.normpath(path): [st.st_size, st.st_mtime_ns] for path, st in archives.items()},
+        }
+        with FileLock(self._index_file):
+            if op.exists(self._index_file):
+                with open(self._index_delta_file, "a") as fh:
+                    print(json.dumps(delta, cls=PathAwareJsonEncoder), file=fh)
+
+    def _refresh_index(self, index):
+        """Bring `index` up to date with any changes to the timestream since it was made.
+
+        The index records the mtime of each directory, and the size and mtime of each
+        archive, that it covers. Only directories whose mtime has changed are listed again,
+        and only new or changed archives are read, so checking an unchanged stream costs a
+        stat per directory and archive. The index file is updated with what was found, as
+        are the mtimes recorded as too recent to trust once they've settled, so that those
+        directories aren't listed again next time. Returns the updated index.
+        """
+        from pyts2.index import TimeStreamIndex, KIND_FILE
+        if "dirs" not in index.meta or "archives" not in index.meta:
+            return index  # an older index, which we can't check
+        dirs, archives = index.meta["dirs"], index.meta["archives"]
+        gone = set()
+        relist = []
+        rescan = []
+        for path, mtime in dirs.items():
+            try:
+                if os.stat(path).st_mtime_ns != mtime:
+                    relist.append(path)
+            except FileNotFoundError:
+                gone.add(path)
+        for path, (size, mtime) in archives.items():
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                gone.add(path)
+                continue
+            if (st.st_size, st.st_mtime_ns) != (size, mtime):
+                gone.add(path)
+                rescan.append(path)
+        if not gone and not relist:
+            return index
+
+        # rescan without any timefilter, so the index stays complete
+        scanner = copy.copy(self)
+        scanner.timefilter = None
+        scanner._scan_record = record = {
+            "dirs": {k: v for k, v in dirs.items() if k not in gone},
+            "archives": {k: v for k, v in archives.items() if k not in gone},
+        }
+        new = []
+        changed_dirs = set()
+        # the index's files in each directory, found in one pass over the index
+        indexed_names = index.file_names_in(relist)
+        for path in rescan:
+            try:
+                kind = self._classify(path, op.basename(path))
+                if kind in ("zip", "tar"):
+                    new.extend(f.fetcher for f in scanner._walk_archive(path, kind, tar_contents=False))
+            except Exception as exc:
+                print(f"\n{exc.__class__.__name__}: {str(exc)} at '{path}'\n", file=stderr)
+        for top in relist:
+            try:
+                subdirs, files, mtime = _listdir(top)
+                record["dirs"][top] = _settled_mtime(mtime)
+            except OSError as exc:
+                print(f"\n{exc.__class__.__name__}: {str(exc)} at '{top}'\n", file=stderr)
+                gone.add(top)
+                continue
+            plain = []
+            for entry in files:
+                path = op.join(top, entry.name)
+                if not entry.is_file():
+                    continue
+                kind = self._classify(path, entry.name)
+                if kind == "file":
+                    plain.append(entry)
+                elif kind is not None and path not in record["archives"] and path not in rescan:
+                    new.extend(f.fetcher for f in scanner._iter_dir_files(top, [entry], tar_contents=False))
+            if {entry.name for entry in plain} != indexed_names[top]:
+                changed_dirs.add(top)
+                new.extend(f.fetcher for f in scanner._iter_dir_files(top, plain, tar_contents=False))
+            for subdir in subdirs:
+                subdir = op.join(top, subdir)
+                if subdir not in dirs:
+                    for root, files in scanner._walk(subdir):
+                        new.extend(f.fetcher for f in scanner._iter_dir_files(root, files, tar_contents=False))
+        if not gone and not changed_dirs and not new:
+            # only directory mtimes changed, e.g. from lock files coming and going. That's
+            # only worth saving if some that were too recent to trust have now settled.
+            settled = any(dirs.get(path) == -1 and mtime != -1 for path, mtime in record["dirs"].items())
+            index.meta = record
+            if settled:
+                self._save_refreshed_index(index)
+            return index
+
+        keep = ~(index.in_containers(gone) | index.in_containers(changed_dirs, kind=KIND_FILE))
+        index = index.merge(keep, TimeStreamIndex.build(new), meta=record)
+        self._save_refreshed_index(index)
+        return index
+
+    def _save_refreshed_index(self, index):
+        # refreshing doesn't use the timefilter, so the index is complete and can be saved
+        try:
+            with FileLock(self._index_file):
+                index.save(self._index_file)
+        except (OSError, FileLockException) as exc:
+            print("Failed to save refreshed timestream index:", str(exc), file=stderr)
 
     @property
     def instants(self):
+        """All instants in the timestream, in sorted order"""
         self.index(progress=False)
-        return self._instants.keys()
+        if self._index is None:
+            return []
+        lo, hi = self._indexed_span()
+        return [self._index.instant(int(i)) for i in lo + np.flatnonzero(self._indexed_mask(lo, hi))]
 
     def getinstant(self, value):
         if isinstance(value, TimestreamFile):
             value = value.instant
         assert(isinstance(value, TSInstant))
         self.index(progress=False)
-        fetcher = self._instants[value]
+        i = self._index.find(value) if self._index is not None else None
+        if i is None:
+            raise KeyError(value)
+        return self._indexed_file(i)
+
+    def _indexed_file(self, i):
+        fetcher = self._index.fetcher(i)
         return TimestreamFile(filename=fetcher.filename, fetcher=fetcher)
 
-    def __getitem__(self, filename):
+    def _indexed_within_filter(self, i):
+        # A saved index has every file in the stream, whatever format this stream reads
+        if self.format is not None and not self._is_timestream_file(self._index.filename(i)):
+            return False
+        return self.timefilter is None or self.timefilter(self._index.instant(i).datetime)
+
+    def _indexed_span(self):
+        """Positions [lo, hi) of the index entries within the timefilter's dates"""
+        tf = self.timefilter
+        if tf is None:
+            return 0, len(self._index)
+        start = dt.datetime.combine(tf.startdate, dt.time()) if tf.startdate is not None else None
+        end = dt.datetime.combine(tf.enddate + dt.timedelta(days=1), dt.time()) if tf.enddate is not None else None
+        return self._index.span(start, end)
+
+    def _indexed_mask(self, lo, hi):
+        """Mask of the index entries [lo, hi) that are within the timefilter and of our format"""
+        if self.timefilter is not None:
+            mask = self._index.within(self.timefilter, lo, hi)
+        else:
+            mask = np.ones(hi - lo, dtype=bool)
+        if self.format is not None:
+            for i in np.flatnonzero(mask):
+                mask[i] = self._is_timestream_file(self._index.filename(lo + int(i)))
+        return mask
+
+    def range(self, start=None, end=None):
+        """Files from `start` up to (but not including) `end`, in order.
+
+        `start` and `end` are TSInstants or datetimes, and either may be None for an
+        open-ended range. The range is found by binary search of the index, and files are
+        only made as they are iterated over.
+        """
         self.index(progress=False)
-        return TimestreamFile(filename=filename, fetcher=self._files[filename])
-
+        if self._index is None:
+            return
+        lo, hi = self._index.span(start, end)
+        for i in lo + np.flatnonzero(self._indexed_mask(lo, hi)):
+            yield self._indexed_file(int(i))
+
+    def extent(self):
+        """(first, last) instants of the stream, regardless of timefilter, or None if empty"""
+        self.index(progress=False)
+        if self._index is None or len(self._index) == 0:
+            return None
+        return self._index.instant(0), self._index.instant(len(self._index) - 1)
+
+    def subsample(self, interval, align="first"):
+        """One file per `interval` (a timedelta), in order.
+
+        With align="first" the first file in each interval is chosen, and with
+        align="centre" the file nearest its middle. Intervals are aligned to the clock
+        (e.g. on the hour and half hour for 30 minutes). Files are chosen from the
+        index, so those skipped are never opened. Raises ValueError unless `interval` is a
+        whole number of seconds, at least one.
+        """
+        seconds = int(interval.total_seconds())
+        if seconds < 1 or interval != dt.timedelta(seconds=seconds):
+            raise ValueError(f"subsample interval must be a whole number of seconds, not {interval}")
+        return self._subsample(seconds, align)
+
+    def _subsample(self, seconds, align):
+        self.index(progress=False)
+        if self._index is None or len(self._index) == 0:
+            return
+        mask = None
+        if self.timefilter is not None or self.format is not None:
+            lo, hi = self._indexed_span()
+            mask = np.zeros(len(self._index), dtype=bool)
+            mask[lo:hi] = self._indexed_mask(lo, hi)
+        for i in self._index.subsample(seconds, align=align, mask=mask):
+            yield self._indexed_file(int(i))
+
+    def nearest(self, instant, tolerance=None):
+        """The file closest in time to `instant`, no more than `tolerance` away.
+
+        `instant` is a TSInstant or datetime, and `tolerance` a timedelta (None for no
+        limit). An exact match of a TSInstant, including its index, is preferred. Raises
+        KeyError if there's no file within `tolerance`.
+        """
+        self.index(progress=False)
+        if self._index is None:
+            raise KeyError(instant)
+        if isinstance(instant, TSInstant):
+            i = self._index.find(instant)
+            if i is not None and self._indexed_within_filter(i):
+                return self._indexed_file(i)
+        if tolerance is not None:
+            tolerance = tolerance.total_seconds()
+        for distance, i in self._index.around(instant):
+            if tolerance is not None and distance > tolerance:
+                break
+            if self._indexed_within_filter(i):
+                return self._indexed_file(i)
+        raise KeyError(instant)
 
+    def __getitem__(self, filename):
+        self.index(progress=False)
+        i = self._index.find_file(filename) if self._index is not None else None
+        if i is None:
+            raise KeyError(filename)
+        return TimestreamFile(filename=filename, fetcher=self._index.fetcher(i))
 
     def _scan_dir(self, basedir):
-        for root, dirs, files in os.walk(basedir):
-            # ensure sorted iteration
-            dirs.sort()
-            files.sort(key=lambda f: extract_datetime(f))
-            for file in files:
-                path = op.join(root, file)
-                if not op.exists(path):
-                    continue
-                if file.startswith('.'):
+        for root, files in self._walk(basedir):
+            for entry in files:
+                if not entry.is_file() or not self._is_timestream_file(entry.name):
                     continue
-                if not path_is_timestream_file(path, extensions=self.format):
-                    continue
-                fetcher = FileContentFetcher(path)
-                self._files[fetcher.filename] = fetcher
+                fetcher = FileContentFetcher(op.join(root, entry.name))
                 yield TimestreamFile(fetcher=fetcher)
 
     def from_inotify(self, basedir):
@@ -372,7 +1021,6 @@ class TimeStream(object):
                     if filename.startswith('.') or not op.exists(path) or not path_is_timestream_file(path, extensions=self.format):
                         continue
                     fetcher = FileContentFetcher(path)
-                    self._files[fetcher.filename] = fetcher
                     yield TimestreamFile(fetcher=fetcher)
             # clean up inotify watcher
             del inot
@@ -388,82 +1036,177 @@ class TimeStream(object):
             if not path_is_timestream_file(path, extensions=self.format):
                 continue
             fetcher = FileContentFetcher(path)
-            self._files[fetcher.filename] = fetcher
             yield TimestreamFile(fetcher=fetcher)
 
-    def iter(self, tar_contents=True):
-        def walk_archive(path):
-            if zipfile.is_zipfile(str(path)):
-                with zipfile.ZipFile(str(path)) as zip:
-                    # ensure sorted iteration
-                    entries = zip.infolist()
-                    entries.sort(key=lambda entry: extract_datetime(entry.filename))
-                    for entry in entries:
-                        if entry.is_dir():
-                            continue
-                        if not path_is_timestream_file(entry.filename, extensions=self.format):
-                            continue
-                        if self.timefilter is not None and not self.timefilter.partial_within(op.basename(entry.filename)):
-                            continue
-                        self._files[op.basename(entry.filename)] = ZipContentFetcher(path, entry.filename)
-                        yield TimestreamFile(filename=entry.filename,
-                                             fetcher=ZipContentFetcher(path, entry.filename))
-            elif tarfile.is_tarfile(path):
-                self.sorted = False
-                #warnings.warn("Extracting files from a tar file. Sorted iteration is not guaranteed")
-                with tarfile.TarFile(path) as tar:
-                    for entry in tar:
-                        if not entry.isfile():
-                            continue
-                        if not path_is_timestream_file(entry.name, extensions=self.format):
-                            continue
-                        if self.timefilter is not None and not self.timefilter.partial_within(op.basename(entry.name)):
-                            continue
-                        if tar_contents:
-                            filebytes = tar.extractfile(entry).read()
-                            yield TimestreamFile.from_bytes(filebytes, filename=entry.name)
-                        else:
-                            self._files[op.basename(entry.name)] = TarContentFetcher(path, entry.name)
-                            yield TimestreamFile(filename=entry.name,
-                                                 fetcher=TarContentFetcher(path, entry.name))
-            else:
-                raise ValueError(f"'{path}' appears not to be an archive")
-
-        def is_archive(path):
-            if op.isdir(path):
-                return False
-            return op.exists(path) and op.isfile(path) and \
-                (zipfile.is_zipfile(str(path)) or tarfile.is_tarfile(path))
-
+    def _classify(self, path, name):
+        """Work out if `name` is a zip, tar, or plain timestream file, or None if none of these.
+
+        Classification is by filename where possible. Only names that could be an
+        archive but don't say so are opened to check their magic bytes.
+        """
+        lname = name.lower()
+        if lname.endswith(".zip"):
+            return "zip"
+        if lname.endswith(".tar"):
+            return "tar"
+        if self._is_timestream_file(name):
+            return "file"
+        if op.splitext(lname)[1] in NOT_ARCHIVE_EXTENSIONS:
+            return None
+        return sniff_archive_type(path)
+
+    def _walk(self, top):
+        """Like os.walk, but yields sorted DirEntry objects for files in each directory.
+
+        DirEntry caches the file type from the directory listing, so this doesn't need to
+        stat each file. Subdirectories are listed in parallel on `scan_threads` threads,
+        but yielded in sorted (i.e. for the standard layout, chronological) order.
+        """
+        top = op.normpath(top)
+        if self.scan_threads <= 1:
+            yield from self._walk_listed(top, None, None)
+            return
+        with ThreadPoolExecutor(max_workers=self.scan_threads) as executor:
+            yield from self._walk_listed(top, executor.submit(_listdir, top), executor)
+
+    def _dir_outside_filter(self, dir):
+        if TS_DIR_RE.match(dir) is None:
+            return False
         try:
-            if is_archive(self.path):
-                yield from walk_archive(self.path)
-        except Exception as exc:
-            print(f"\n{exc.__class__.__name__}: {str(exc)} at '{path}'\n", file=stderr)
+            return not self.timefilter.partial_within(dir)
+        except ValueError:
+            # looks like a partial date but isn't one (e.g. 2001_13), so it's not ours to skip
+            return False
 
-        for root, dirs, files in os.walk(self.path):
+    def _walk_listed(self, top, listing, executor):
+        try:
+            dirs, files, mtime = listing.result() if listing is not None else _listdir(top)
+        except OSError as exc:
+            print(f"\n{exc.__class__.__name__}: {str(exc)} at '{top}'\n", file=stderr)
+            return
+        if self._scan_record is not None:
+            self._scan_record["dirs"][top] = _settled_mtime(mtime)
+        yield top, files
+        if self.timefilter is not None:
+            # the standard layout's directory names are partial dates, so we can skip any
+            # that can't contain files within the filter without listing them
+            dirs = [dir for dir in dirs if not self._dir_outside_filter(dir)]
+        subdirs = [op.join(top, dir) for dir in dirs]
+        if executor is None:
+            for subdir in subdirs:
+                yield from self._walk_listed(subdir, None, None)
+            return
+        # list all our subdirectories at once, while we descend into them in order
+        listings = [executor.submit(_listdir, subdir) for subdir in subdirs]
+        try:
+            for subdir, listing in zip(subdirs, listings):
+                yield from self._walk_listed(subdir, listing, executor)
+        finally:
+            for listing in listings:
+                listing.cancel()
+
+    def _walk_archive(self, path, kind, tar_contents=True):
+        path = op.normpath(path)
+        if self._scan_record is not None:
+            st = os.stat(path)
+            self._scan_record["archives"][str(path)] = [st.st_size, _settled_mtime(st.st_mtime_ns)]
+        if kind == "zip":
+            with archive_pool.open(path, "zip") as zip:
+                entries = list(zip.infolist())
             # ensure sorted iteration
-            dirs.sort()
-            files.sort(key=lambda f: extract_datetime(f))
-            for file in files:
-                path = op.join(root, file)
-                if file.startswith("."):
+            entries.sort(key=lambda entry: extract_datetime(entry.filename))
+            for entry in entries:
+                if entry.is_dir():
                     continue
-                try:
-                    if not (op.isfile(path) and os.access(path, os.R_OK)):
-                        raise RuntimeError(f"Could not read {path}, skipping")
-                    if is_archive(path):
-                        if self.timefilter is not None and not self.timefilter.partial_within(file):
-                            continue
-                        yield from walk_archive(path)
-                    if path_is_timestream_file(path, extensions=self.format):
-                        if self.timefilter is not None and not self.timefilter.partial_within(file):
-                            continue
-                        fetcher = FileContentFetcher(path)
-                        self._files[op.basename(path)] = fetcher
-                        yield TimestreamFile(filename=op.basename(path), fetcher=fetcher)
-                except Exception as exc:
-                    print(f"\n{exc.__class__.__name__}: {str(exc)} at '{path}'\n", file=stderr)
+                if not self._is_timestream_file(entry.filename):
+                    continue
+                if self.timefilter is not None and not self.timefilter.partial_within(op.basename(entry.filename)):
+                    continue
+                yield TimestreamFile(filename=entry.filename,
+                                     fetcher=ZipContentFetcher(path, entry.filename))
+        elif kind == "tar":
+            with archive_pool.open(path, "tar") as tar:
+                # Only headers are read here, which also gives each member's offset.
+                # So we can sort like zips, then read members directly by offset.
+                entries = list(tar.getmembers())
+            entries.sort(key=lambda entry: extract_datetime(entry.name))
+            for entry in entries:
+                if not entry.isfile():
+                    continue
+                if not self._is_timestream_file(entry.name):
+                    continue
+                if self.timefilter is not None and not self.timefilter.partial_within(op.basename(entry.name)):
+                    continue
+                fetcher = TarContentFetcher(path, entry.name, member=TarMember.from_tarinfo(entry))
+                if tar_contents:
+                    yield TimestreamFile.from_bytes(fetcher.get(), filename=entry.name)
+                else:
+                    yield TimestreamFile(filename=entry.name, fetcher=fetcher)
+        else:
+            raise ValueError(f"'{path}' appears not to be an archive")
+
+    def _iter_dir_files(self, root, files, tar_contents=True):
+        """Timestream files (including those within archives) among DirEntries `files` of `root`"""
+        for entry in files:
+            file = entry.name
+            path = op.join(root, file)
+            try:
+                if not entry.is_file():
+                    continue
+                kind = self._classify(path, file)
+                if kind is None:
+                    continue
+                if self.timefilter is not None and not self.timefilter.partial_within(file):
+                    continue
+                if kind == "file":
+                    yield TimestreamFile(filename=file, fetcher=FileContentFetcher(path))
+                else:
+                    yield from self._walk_archive(path, kind, tar_contents=tar_contents)
+            except Exception as exc:
+                print(f"\n{exc.__class__.__name__}: {str(exc)} at '{path}'\n", file=stderr)
+
+    def iter(self, tar_contents=True):
+        if op.isfile(self.path):
+            try:
+                kind = self._classify(self.path, op.basename(self.path))
+                if kind in ("zip", "tar"):
+                    yield from self._walk_archive(self.path, kind, tar_contents=tar_contents)
+            except Exception as exc:
+                print(f"\n{exc.__class__.__name__}: {str(exc)} at '{self.path}'\n", file=stderr)
+            return
+
+        for root, files in self._walk(self.path):
+            yield from self._iter_dir_files(root, files, tar_contents=tar_contents)
+
+    def prefetch(self, nthreads=4, max_files=32, max_bytes=512*1024**2, **kwargs):
+        """Iterate over files, loading the content of upcoming files in the background.
+
+        Content for up to `max_files` files ahead is read on a pool of `nthreads` threads,
+        so processing of one file overlaps with reading the next. Read-ahead also pauses
+        once `max_bytes` of loaded content is waiting to be consumed. Other arguments are
+        passed to `iter()`.
+        """
+        def load(file):
+            return len(file.content)
+
+        files = self.iter(**kwargs)
+        window = deque()
+        loaded_bytes = 0
+        with ThreadPoolExecutor(max_workers=nthreads) as executor:
+            while True:
+                loaded_bytes = sum(fut.result() for _, fut in window
+                                   if fut.done() and fut.exception() is None)
+                while len(window) < max_files and loaded_bytes < max_bytes:
+                    file = next(files, None)
+                    if file is None:
+                        break
+                    window.append((file, executor.submit(load, file)))
+                if not window:
+                    return
+                file, fut = window.popleft()
+                # a failed read is left for the consumer to hit (and report) again
+                wait([fut])
+                yield file
 
     def _timestream_path(self, file):
         """Gets path for timestream file."""
@@ -498,11 +1241,28 @@ class TimeStream(object):
             bpath = f"{self.path}/%Y/%Y_%m/%Y_%m_%d/%Y_%m_%d_%H/{self.name}_%Y_%m_%d_%H_%M_%S.{file.format}.zip"
         return file.instant.datetime.strftime(bpath)
 
+    def _strip_root_bundle_ext(self, file):
+        if self.bundle == "root":
+            self.path = str(self.path)
+            for ext in [".tar", ".zip", f".{file.format}"]:
+                if self.path.lower().endswith(ext):
+                    self.path = self.path[:-len(ext)]
+            self.path = Path(self.path)
+
+    def _output_group(self, file):
+        """The bundle (or for unbundled streams, the directory) `file` will be written to"""
+        if self.bundle == "none":
+            return op.dirname(op.join(self.path, self._timestream_path(file)))
+        self._strip_root_bundle_ext(file)
+        return self._bundle_archive_path(file)
+
     def write(self, file):
-        if op.exists(self._index_file):
+        self._index = None
+        if op.exists(self._json_index_file):
+            # the old index format can't be appended to
             with FileLock(self._index_file):
                 try:
-                    os.unlink(self._index_file)
+                    os.unlink(self._json_index_file)
                 except Exception as exc:
                     print(str(exc), file=stderr)
                     if stderr.isatty():
@@ -515,34 +1275,438 @@ class TimeStream(object):
         if self.bundle == "none":
             outpath = op.join(self.path, subpath)
             os.makedirs(op.dirname(outpath), exist_ok=True)
+            if file._content is None and isinstance(file.fetcher, FileContentFetcher) and \
+                    op.exists(outpath) and op.samefile(file.fetcher.pathondisk, outpath):
+                return  # already there, and truncating it would pull the rug from under its mmap
             with FileLock(outpath):
                 with open(outpath, 'wb') as fh:
-                    fh.write(file.content)
+                    fh.write(file.content_view)
+            if self._writer is not None:
+                self._writer.log_file(outpath)
+            else:
+                self._log_written([FileContentFetcher(outpath)], dirs=[op.dirname(outpath)])
         else:
-            if self.bundle == "root":
-                self.path = str(self.path)
-                for ext in [".tar", ".zip", f".{file.format}"]:
-                    if self.path.lower().endswith(ext):
-                        self.path = self.path[:-len(ext)]
-                self.path = Path(self.path)
+            self._strip_root_bundle_ext(file)
             bundle = self._bundle_archive_path(file)
             bdir = op.dirname(bundle)
             if bdir:  # i.e. if not $PWD
                 os.makedirs(bdir, exist_ok=True)
+            pathinzip = op.join(self.name, subpath)
+            if self._writer is not None:
+                self._writer.write_member(bundle, pathinzip, file.content_view)
+                return
             with FileLock(bundle):
                 with zipfile.ZipFile(bundle, mode="a", compression=zipfile.ZIP_STORED,
                                      allowZip64=True) as zip:
-                    pathinzip = op.join(self.name, subpath)
-                    if pathinzip not in zip.namelist():
-                        zip.writestr(pathinzip, file.content)
-                    else:
-                        file_crc = zlib.crc32(file.content)
-                        zip_crc = zip.getinfo(pathinzip).CRC
-                        if file_crc != zip_crc:
-                            raise RuntimeError(f"ERROR: trying to overwrite file with different content: zip={bundle}, subpath={subpath}")
+                    _zip_write_once(zip, pathinzip, file.content_view)
+                st = os.stat(bundle)
+            self._log_written([ZipContentFetcher(op.normpath(bundle), pathinzip)],
+                              dirs=[bdir or "."], archives={bundle: st})
+
+    def writer(self, **kwargs):
+        """Start a writer session, which keeps bundles open between writes.
+
+        Use as a context manager; while it is active, `write()` goes via the session.
+        See `BundleWriter` for arguments.
+        """
+        return BundleWriter(self, **kwargs)
+
+    def parallel_writer(self, nworkers, **kwargs):
+        """Write from `nworkers` processes, each owning a disjoint set of bundles.
+
+        See `ParallelWriter` for arguments.
+        """
+        return ParallelWriter(self, nworkers, **kwargs)
 
     def __iter__(self):
         return self.iter()
 
     def close(self):
-        pass
+        if self._writer is not None:
+            self._writer.close()
+
+
+def _instant_key(instant):
+    # as TimeStreamIndex sorts
+    return (instant.datetime, instant.index or "")
+
+
+class _Lookahead(object):
+    def __init__(self, iterable):
+        self._iter = iter(iterable)
+        self._buf = deque()
+
+    def peek(self, n=0):
+        """The item `n` ahead, or None if the iterable is exhausted before it"""
+        while len(self._buf) <= n:
+            try:
+                self._buf.append(next(self._iter))
+            except StopIteration:
+                return None
+        return self._buf[n]
+
+    def next(self):
+        self.peek()
+        return self._buf.popleft()
+
+
+def join_timestreams(left, right, tolerance=None):
+    """Join two sequences of TimestreamFiles, each sorted by instant, on their instants.
+
+    Yields (left file, right file) pairs, in order, with None in place of a file that has
+    no match on the other side. Without `tolerance` files match if their instants are
+    equal. With `tolerance` (a timedelta), files match if within `tolerance` of each
+    other; each file matches at most one other, and where a file could match either of
+    two neighbours it takes the nearer. Left files that share an instant (e.g. the same
+    image in two directories) all match the same right file. Both inputs are read once,
+    in step, so this runs in constant memory. Raises ValueError if either input turns out not to be sorted.
+
+    ```
+    for ephemeral, resource in join_timestreams(eph_ts.range(), res_ts.range()):
+        if resource is None:
+            print(ephemeral.filename, "is not in the resource")
+    ```
+    """
+    def ordered(files, side):
+        last = None
+        for file in files:
+            key = _instant_key(file.instant)
+            if last is not None and key < last:
+                raise ValueError(f"The {side} timestream is not sorted by time at {file.instant}")
+            last = key
+            yield file
+
+    def distance(a, b):
+        return abs(a.instant.datetime - b.instant.datetime)
+
+    def match():
+        l, r = left.next(), right.peek()
+        # keep the right file for any following left files at the same instant
+        if left.peek() is None or _instant_key(left.peek().instant) != _instant_key(l.instant):
+            right.next()
+        return l, r
+
+    left = _Lookahead(ordered(left, "left"))
+    right = _Lookahead(ordered(right, "right"))
+    while left.peek() is not None and right.peek() is not None:
+        l, r = left.peek(), right.peek()
+        if tolerance is None:
+            lkey, rkey = _instant_key(l.instant), _instant_key(r.instant)
+            if lkey == rkey:
+                yield match()
+            elif lkey < rkey:
+                yield left.next(), None
+            else:
+                yield None, right.next()
+            continue
+        d = distance(l, r)
+        if d > tolerance:
+            if l.instant.datetime < r.instant.datetime:
+                yield left.next(), None
+            else:
+                yield None, right.next()
+        elif right.peek(1) is not None and distance(l, right.peek(1)) < d:
+            yield None, right.next()
+        elif left.peek(1) is not None and distance(left.peek(1), r) < d:
+            yield left.next(), None
+        else:
+            yield match()
+    while left.peek() is not None:
+        yield left.next(), None
+    while right.peek() is not None:
+        yield None, right.next()
+
+
+def _zip_write_once(zip, pathinzip, content):
+    """Add a member to an open zip, unless an identical member is already there"""
+    # NameToInfo is zipfile's in-memory name lookup, so this doesn't scan the namelist
+    if pathinzip not in zip.NameToInfo:
+        zip.writestr(pathinzip, content)
+    elif zlib.crc32(content) != zip.getinfo(pathinzip).CRC:
+        raise RuntimeError(f"ERROR: trying to overwrite file with different content: zip={zip.filename}, path={pathinzip}")
+
+
+class _OpenBundle(object):
+    """A bundle being written to in a writer session.
+
+    New members go to a hidden side file next to the bundle, which is merged into the
+    bundle (under its lock) on close. Until then the bundle itself is untouched, so
+    readers and other writers can use it, and a crash loses only what's in the side file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.sidepath = op.join(op.dirname(path), f".{op.basename(path)}.{os.getpid()}.pending")
+        # names & CRCs of members already in the bundle, to catch conflicting writes early
+        self.existing = {}
+        if op.exists(path):
+            with FileLock(path):
+                with zipfile.ZipFile(path) as zfh:
+                    self.existing = {info.filename: info.CRC for info in zfh.infolist()}
+        self.zip = zipfile.ZipFile(self.sidepath, mode="w", compression=zipfile.ZIP_STORED,
+                                   allowZip64=True)
+        self.written = []
+        self.opened_at = time.monotonic()
+        self.stat = None
+
+    def write(self, pathinzip, content):
+        crc = self.existing.get(pathinzip)
+        if crc is not None:
+            if zlib.crc32(content) != crc:
+                raise RuntimeError(f"ERROR: trying to overwrite file with different content: zip={self.path}, path={pathinzip}")
+            return
+        if pathinzip not in self.zip.NameToInfo:
+            self.written.append(pathinzip)
+        _zip_write_once(self.zip, pathinzip, content)
+
+    def close(self):
+        self.zip.close()
+        if self.written:
+            # the side file is kept if merging fails, so nothing written is lost
+            with FileLock(self.path):
+                with zipfile.ZipFile(self.sidepath) as side, \
+                        zipfile.ZipFile(self.path, mode="a", compression=zipfile.ZIP_STORED,
+                                        allowZip64=True) as zfh:
+                    for name in self.written:
+                        _zip_write_once(zfh, name, side.read(name))
+                self.stat = os.stat(self.path)
+        os.unlink(self.sidepath)
+
+
+class BundleWriter(object):
+    """A writer session for a TimeStream, which batches writes to zip bundles.
+
+    Normally each bundled write locks the bundle, re-reads its central directory, adds
+    one member and rewrites the central directory. Within a session, new members of each
+    bundle are collected in a side file, and merged into the bundle in one go when the
+    bundle is rolled over (more than `max_open` bundles in use), flushed, or the session
+    is closed. Each bundle is also flushed after `flush_every` writes or `flush_seconds`
+    seconds. The bundle is only locked, and only lacks a valid central directory, while
+    a merge is under way, so an interrupted session loses at most the unmerged writes
+    and never the bundle's existing members.
+
+    Files written are added to the stream's index (if it has one) at each flush, rather
+    than per file.
+
+    ```
+    with stream.writer():
+        for file in files:
+            stream.write(file)
+    ```
+    """
+
+    def __init__(self, stream, max_open=4, flush_every=1000, flush_seconds=300):
+        self.stream = stream
+        self.max_open = max_open
+        self.flush_every = flush_every
+        self.flush_seconds = flush_seconds
+        self._bundles = OrderedDict()
+        self._files = []
+        self._lock = RLock()
+
+    def write_member(self, bundle, pathinzip, content):
+        with self._lock:
+            ob = self._bundles.get(bundle)
+            if ob is None:
+                ob = _OpenBundle(bundle)
+                self._bundles[bundle] = ob
+                while len(self._bundles) > max(self.max_open, 1):
+                    _, old = self._bundles.popitem(last=False)
+                    self._commit([old])
+            self._bundles.move_to_end(bundle)
+            ob.write(pathinzip, content)
+            if len(ob.written) >= self.flush_every or \
+                    time.monotonic() - ob.opened_at >= self.flush_seconds:
+                self.flush(bundle)
+
+    def log_file(self, path):
+        """Note an unbundled file written during the session, for the index"""
+        with self._lock:
+            self._files.append(path)
+            if len(self._files) >= self.flush_every:
+                self._commit([], self._files)
+                self._files = []
+
+    def flush(self, bundle=None):
+        """Commit the central directory of one or all open bundles"""
+        with self._lock:
+            closing = [self._bundles.pop(path) for path in list(self._bundles)
+                       if bundle is None or path == bundle]
+            files = []
+            if bundle is None:
+                files, self._files = self._files, []
+            self._commit(closing, files)
+
+    def _commit(self, bundles, files=()):
+        fetchers = []
+        dirs = set()
+        archives = {}
+        for ob in bundles:
+            ob.close()
+            if not ob.written:
+                continue
+            path = op.normpath(ob.path)
+            fetchers.extend(ZipContentFetcher(path, name) for name in ob.written)
+            dirs.add(op.dirname(path) or ".")
+            archives[path] = ob.stat
+        for path in files:
+            fetchers.append(FileContentFetcher(path))
+            dirs.add(op.dirname(path))
+        if fetchers:
+            self.stream._log_written(fetchers, dirs=dirs, archives=archives)
+
+    def close(self):
+        self.flush()
+        if self.stream._writer is self:
+            self.stream._writer = None
+
+    def __enter__(self):
+        if self.stream._writer is not None:
+            raise RuntimeError("TimeStream already has an active writer session")
+        self.stream._writer = self
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+
+def _parallel_writer_worker(i, stream, inq, msgq, session_kwargs):
+    n = 0
+    with stream.writer(**session_kwargs):
+        while True:
+            file = inq.get()
+            if file is None:
+                break
+            try:
+                stream.write(file)
+            except Exception as exc:
+                msgq.put(("error", i, f"{exc.__class__.__name__}: {str(exc)} while writing '{file.filename}'"))
+            n += 1
+    # only once the session is closed (so everything is committed) are the files acknowledged
+    msgq.put(("done", i, n))
+
+
+def _snapshot(file):
+    # mp.Queue pickles on a background thread after put() returns, so queue a copy that the
+    # caller (e.g. a pipeline updating the report) can't change under it
+    content = file._content
+    if content is None and file.fetcher is None:
+        content = file.content
+    return TimestreamFile(instant=file.instant, filename=file.filename, fetcher=file.fetcher,
+                          content=content, report=dict(file.report), format=file.format)
+
+
+class ParallelWriter(object):
+    """Writes files to a TimeStream from a pool of worker processes.
+
+    Files are routed by the bundle they belong in (see `TimeStream._bundle_archive_path`),
+    or for unbundled streams by their output directory. Each bundle is owned by exactly
+    one worker, which keeps it open in a writer session, so workers never contend for a
+    bundle's lock and throughput scales with the number of bundles being written at once.
+
+    Errors in workers are handled according to the stream's `onerror`: "warn" prints
+    them as they arrive, "raise" raises a RuntimeError on close(), "skip" ignores them.
+    All error messages are kept in `errors`. A worker that dies, or exits without
+    acknowledging every file sent to it, is an error naming the files that may be lost.
+    """
+
+    def __init__(self, stream, nworkers, queue_size=16, **session_kwargs):
+        import multiprocessing as mp
+        if stream.name is None:
+            raise RuntimeError("TSv2Stream not opened")
+        self.stream = stream
+        self.errors = []
+        self._owners = {}
+        self._msgq = mp.Queue()
+        self._queues = [mp.Queue(maxsize=queue_size) for _ in range(max(nworkers, 1))]
+        # names of files sent to each worker that it hasn't acknowledged, in the order sent
+        self._pending = [deque() for _ in self._queues]
+        self._done = [False for _ in self._queues]
+        self._procs = [mp.Process(target=_parallel_writer_worker, daemon=True,
+                                  args=(i, stream, q, self._msgq, session_kwargs))
+                       for i, q in enumerate(self._queues)]
+        for proc in self._procs:
+            proc.start()
+
+    def _error(self, msg):
+        self.errors.append(msg)
+        if self.stream.onerror == "warn":
+            print(f"\n{msg}\n", file=stderr)
+
+    def _handle(self, msg):
+        kind, worker, value = msg
+        if kind == "error":
+            self._error(value)
+        elif kind == "done":
+            for _ in range(min(value, len(self._pending[worker]))):
+                self._pending[worker].popleft()
+            self._done[worker] = True
+
+    def _collect_errors(self):
+        while True:
+            try:
+                msg = self._msgq.get_nowait()
+            except queue.Empty:
+                return
+            self._handle(msg)
+
+    def _put(self, worker, item):
+        while True:
+            try:
+                self._queues[worker].put(item, timeout=1)
+                return
+            except queue.Full:
+                if not self._procs[worker].is_alive():
+                    raise RuntimeError("TimeStream writer process died unexpectedly")
+
+    def write(self, file):
+        if not isinstance(file, TimestreamFile):
+            raise TypeError("file should be a TimestreamFile")
+        group = self.stream._output_group(file)
+        worker = self._owners.get(group)
+        if worker is None:
+            # hand out groups round-robin, as consecutive bundles tend to be written together
+            worker = len(self._owners) % len(self._procs)
+            self._owners[group] = worker
+        self._put(worker, _snapshot(file))
+        self._pending[worker].append(file.filename)
+        self._collect_errors()
+
+    def close(self):
+        for i, proc in enumerate(self._procs):
+            if proc.is_alive():
+                try:
+                    self._put(i, None)
+                except RuntimeError:
+                    pass  # died since, which is reported below
+        # a process that has put messages on a queue doesn't exit until they've been taken,
+        # so keep taking them while we wait for the workers
+        while any(proc.is_alive() for proc in self._procs):
+            try:
+                self._handle(self._msgq.get(timeout=0.1))
+            except queue.Empty:
+                pass
+        for proc in self._procs:
+            proc.join()
+        # workers that exited cleanly have sent their acknowledgement, wait until we have it
+        while not all(done or proc.exitcode != 0 for done, proc in zip(self._done, self._procs)):
+            try:
+                self._handle(self._msgq.get(timeout=5))
+            except queue.Empty:
+                break
+        self._collect_errors()
+        for i, proc in enumerate(self._procs):
+            lost = self._pending[i]
+            if proc.exitcode != 0 or not self._done[i] or lost:
+                names = ", ".join(list(lost)[:5]) + (", ..." if len(lost) > 5 else "")
+                self._error(f"TimeStream writer process {i} exited with code {proc.exitcode}, "
+                            f"{len(lost)} file(s) may not have been written: {names}")
+        if self.errors and self.stream.onerror == "raise":
+            raise RuntimeError(f"{len(self.errors)} file(s) failed to write, first error: {self.errors[0]}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -100,3 +100,213 @@ def test_pipeline(data, tmpdir):
         assert files == newfiles
     dotest(1)
     dotest(3)
+
+
+def test_bounded_map():
+    from concurrent.futures import ThreadPoolExecutor
+    from pyts2.pipeline.base import bounded_map
+
+    consumed = []
+
+    def items():
+        for i in range(20):
+            consumed.append(i)
+            yield i
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        results = bounded_map(executor, lambda x: x * 2, items(), max_inflight=3)
+        assert next(results) == 0
+        # only a window's worth of input has been taken from the iterator
+        assert len(consumed) <= 4
+        assert list(results) == [x * 2 for x in range(1, 20)]
+
+        unordered = bounded_map(executor, lambda x: x * 2, range(20), max_inflight=3, ordered=False)
+        assert sorted(unordered) == [x * 2 for x in range(20)]
+
+
+def test_pipeline_unordered(data):
+    pipe = TSPipeline(FileStatsStep())
+    expect = sorted(str(f.instant) for f in TimeStream(data("timestreams/flat")))
+    got = [str(f.instant) for f in pipe.process(TimeStream(data("timestreams/flat")),
+                                                   ncpus=2, max_inflight=2, ordered=False)]
+    assert sorted(got) == expect
+
+
+def test_pipeline_report_results(data):
+    pipe = TSPipeline(FileStatsStep(), DecodeImageFileStep())
+    expect = {str(f.instant): f.md5sum for f in TimeStream(data("timestreams/flat"))}
+    got = {}
+    for file in pipe.process(TimeStream(data("timestreams/flat")), ncpus=2, results="report"):
+        assert type(file) is TimestreamFile
+        assert file._content is None
+        assert file.report["FileSize"] > 0
+        got[str(file.instant)] = file.md5sum
+    assert got == expect
+
+    with pytest.raises(ValueError):
+        list(pipe.process(TimeStream(data("timestreams/flat")), ncpus=2, results="pixels"))
+
+
+def test_worker_keeps_no_reports(data):
+    from pyts2.pipeline.base import _init_worker, _process_in_worker, _worker_task
+    inner = TSPipeline(FileStatsStep())
+    _init_worker(TSPipeline(inner, DecodeImageFileStep()))
+    for file in TimeStream(data("timestreams/flat")):
+        result, stats = _process_in_worker(_worker_task(file), results="report")
+        assert result[3]["FileSize"] > 0
+    from pyts2.pipeline.base import _worker_pipeline
+    assert len(_worker_pipeline.report.data) == 0
+    assert len(_worker_pipeline.steps[0].report.data) == 0
+    _init_worker(None)
+
+
+def test_pipeline_threads(data, tmpdir):
+    output = TimeStream(tmpdir.join("threaded"))
+    pipe = TSPipeline(FileStatsStep(), WriteFileStep(output))
+
+    files = {}
+    for file in pipe.process(TimeStream(data("timestreams/flat")), ncpus=3, executor="thread"):
+        files[str(file.instant)] = file.md5sum
+    assert files == {str(f.instant): f.md5sum for f in TimeStream(data("timestreams/flat"))}
+    assert files == {str(f.instant): f.md5sum for f in output}
+    assert len(pipe.report.data) == len(files)
+
+
+def test_process_to_threads(data, tmpdir):
+    output = TimeStream(tmpdir.join("out"), format="tif", bundle_level="day", name="out")
+
+    def no_processes(*args, **kwargs):
+        raise AssertionError("thread mode shouldn't start writer processes")
+    output.parallel_writer = no_processes
+    pipe = TSPipeline(FileStatsStep())
+    pipe.process_to(TimeStream(data("timestreams/flat")), output, ncpus=3, executor="thread")
+    assert sorted(f.md5sum for f in output) == sorted(f.md5sum for f in TimeStream(data("timestreams/flat")))
+
+    with pytest.raises(ValueError):
+        list(pipe.process(TimeStream(data("timestreams/flat")), ncpus=3, executor="greenlet"))
+
+
+def test_staged_pipeline(data, tmpdir):
+    output = TimeStream(tmpdir.join("staged"))
+    pipe = TSPipeline(
+        Stage(FileStatsStep(), workers=3),
+        Stage(DecodeImageFileStep(), EncodeImageFileStep(format="png"), workers=2, executor="process"),
+        FilterStep(lambda f: not f.filename.startswith("2001_02_01_10"), message="skip"),
+        Stage(WriteFileStep(output), workers=1, queue_size=1),
+    )
+    expect = [str(f.instant) for f in TimeStream(data("timestreams/flat"))]
+    got = [str(f.instant) for f in pipe.process(TimeStream(data("timestreams/flat")), max_inflight=4)]
+    assert got == expect
+
+    written = sorted(str(f.instant) for f in output)
+    assert written == [i for i in expect if not i.startswith("2001_02_01_10")]
+    assert [st["Files"] for st in pipe.stage_stats] == [len(expect)] * 3 + [len(written)]
+    assert pipe.stage_stats[1]["Stage"] == "DecodeImageFileStep+EncodeImageFileStep"
+    assert all(st["MaxQueueDepth"] <= st["QueueSize"] for st in pipe.stage_stats)
+
+
+def test_async_runner(data, tmpdir):
+    from pyts2.pipeline.base import PipelineStep
+    from pyts2.pipeline.live import AsyncPipelineRunner
+    import threading
+    import time
+
+    class SlowSend(PipelineStep):
+        io_bound = True
+
+        def __init__(self):
+            self.active = 0
+            self.most_active = 0
+            self.lock = threading.Lock()
+
+        def process_file(self, file):
+            with self.lock:
+                self.active += 1
+                self.most_active = max(self.most_active, self.active)
+            time.sleep(0.05)
+            with self.lock:
+                self.active -= 1
+            return file
+
+    output = TimeStream(tmpdir.join("live"))
+    sender = SlowSend()
+    pipe = TSPipeline(FileStatsStep(),
+                      FilterStep(lambda f: not f.filename.startswith("2001_02_01_10"), message="skip"),
+                      WriteFileStep(output), sender)
+    done = []
+    AsyncPipelineRunner(pipe, ncpus=2, io_threads=4).run(TimeStream(data("timestreams/flat")),
+                                                          on_done=done.append)
+    expect = sorted(str(f.instant) for f in TimeStream(data("timestreams/flat")))
+    assert sorted(str(f.instant) for f in done) == expect
+    assert pipe.n == len(expect)
+    assert sorted(str(f.instant) for f in output) == [i for i in expect if not i.startswith("2001_02_01_10")]
+    assert sender.most_active > 1  # sends for different files overlapped
+
+
+def test_step_timings(data):
+    from pyts2.pipeline.base import print_step_timings
+    from io import StringIO
+
+    for kwargs in ({"ncpus": 1}, {"ncpus": 2}, {"ncpus": 2, "executor": "thread"}):
+        inner = TSPipeline(FileStatsStep())
+        # the same step twice is timed at each position
+        stats = FileStatsStep()
+        pipe = TSPipeline(stats, DecodeImageFileStep(), TeeStep(inner), stats,
+                          report_step_times=True)
+        files = list(pipe.process(TimeStream(data("timestreams/flat")), **kwargs))
+        timings = pipe.all_timings()
+        assert list(timings) == ["FileStatsStep", "DecodeImageFileStep", "TeeStep", "FileStatsStep#2",
+                                 "TeeStep/FileStatsStep"]
+        for calls, wall, cpu, nin, nout in timings.values():
+            assert calls == len(files)
+            assert wall >= 0 and cpu >= 0
+        # decoding loads content and produces pixels
+        assert timings["DecodeImageFileStep"][3] > 0
+        assert timings["DecodeImageFileStep"][4] > timings["DecodeImageFileStep"][3]
+        for file in files:
+            assert file.report["StepSeconds_DecodeImageFileStep"] >= 0
+        table = StringIO()
+        print_step_timings(timings, file=table)
+        assert "\nDecodeImageFileStep\t10\t" in table.getvalue()
+
+
+def test_memory_profile(data):
+    from pyts2.pipeline.base import MemoryProfile, print_memory_profile
+    from io import StringIO
+    import tracemalloc
+
+    for kwargs in ({"ncpus": 1}, {"ncpus": 2}):
+        pipe = TSPipeline(FileStatsStep(), DecodeImageFileStep(), TeeStep(TSPipeline(FileStatsStep())),
+                          profile_memory=True)
+        files = list(pipe.process(TimeStream(data("timestreams/flat")), **kwargs))
+        memory = pipe.all_memory()
+        assert list(memory.rows) == ["FileStatsStep", "DecodeImageFileStep", "TeeStep"]
+        for calls, peak, growth, maxgrowth in memory.rows.values():
+            assert calls == len(files)
+        # decoding allocates (at least) the float pixels
+        assert memory.rows["DecodeImageFileStep"][1] >= files[0].pixels.nbytes
+        assert all(file.report["MemoryPeakMB"] >= 0 for file in files)
+        assert len(memory.worst) == 10
+        assert memory.max_rss > 0
+        out = StringIO()
+        print_memory_profile(memory, file=out)
+        assert "DecodeImageFileStep" in out.getvalue()
+        pipe.finish()
+        assert not tracemalloc.is_tracing()
+
+    # tracemalloc can't tell threads' allocations apart
+    pipe = TSPipeline(FileStatsStep(), profile_memory=True)
+    with pytest.raises(ValueError):
+        list(pipe.process(TimeStream(data("timestreams/flat")), ncpus=2, executor="thread"))
+    with pytest.raises(ValueError):
+        list(TSPipeline(Stage(FileStatsStep()), profile_memory=True).process(TimeStream(data("timestreams/flat"))))
+
+    merged = MemoryProfile(nworst=2)
+    merged.add("A", "a.jpg", 10, 1, 100)
+    other = MemoryProfile(nworst=2)
+    other.add("A", "b.jpg", 30, 2, 50)
+    other.add("B", "c.jpg", 20, 3, 200)
+    merged.merge(other)
+    assert merged.rows["A"] == [2, 30, 3, 2]
+    assert sorted(merged.worst, reverse=True) == [(30, "b.jpg", "A"), (20, "c.jpg", "B")]
+    assert merged.max_rss == 200
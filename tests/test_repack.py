@@ -0,0 +1,36 @@
+from pyts2.scripts.repack import repack_zip, repack_main
+from pyts2.timestream import TimeStream
+from pyts2.time import *
+from pyts2.utils import find_files
+
+from .utils import *
+from .data import *
+
+import warnings
+import zipfile
+
+
+def test_repack_zip(data, tmpdir):
+    files = list(TimeStream(data("timestreams/nested")))
+    bundle = str(tmpdir.join("bundle.zip"))
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")  # zipfile warns about the duplicate
+        with zipfile.ZipFile(bundle, "w") as zfh:
+            for file in reversed(files):
+                zfh.writestr(file.filename, file.content)
+            zfh.writestr(files[0].filename, files[0].content)
+
+    assert repack_zip(bundle) == (10, 1)
+
+    with zipfile.ZipFile(bundle) as zfh:
+        assert zfh.namelist() == [f.filename for f in files]
+        for file in files:
+            assert zfh.read(file.filename) == file.content
+
+
+def test_repack_resplit(data, tmpdir):
+    outpath = tmpdir.join("output")
+    repack_main(data("timestreams/zipball-day"), output=outpath, bundle="month")
+    assert set(find_files(outpath)) == {str(outpath.join("2001", "output_2001_02.tif.zip"))}
+    for i, file in enumerate(TimeStream(outpath)):
+        assert file.instant == TSInstant(SMALL_TIMESTREAMS["expect_times"][i], index=None)
@@ -6,6 +6,8 @@ from .utils import *
 from .data import *
 
 import io
+import hashlib
+import shutil
 import datetime as dt
 
 
@@ -27,7 +29,7 @@ def test_read(data):
     for timestream in timestreams:
         stream = TimeStream(timestream)
         for i, file in enumerate(stream):
-            assert stream.sorted == ('tar' not in timestream)
+            assert stream.sorted
             assert isinstance(file.instant, TSInstant)
             if stream.sorted:
                 assert file.instant == expect_insts[i]
@@ -155,10 +157,7 @@ def test_read_with_filter(data):
     for timestream in timestreams:
         stream = TimeStream(timestream, timefilter=tfilter)
         for i, file in enumerate(stream):
-            if stream.sorted:
-                assert file.instant == expect_insts[i]
-            else:
-                assert file.instant in expect_insts
+            assert file.instant == expect_insts[i]
         assert list(sorted(stream.instants)) == expect_insts
 
 
@@ -218,3 +217,565 @@ def test_subsecond_output(tmpdir, data):
 
         expect = {str(tmpdir.join(subdir, x)) for x in outputs[add_subsec]}
         assert set(find_files(tmpdir.join(subdir))) == expect
+
+
+def test_archive_pool(data):
+    from pyts2.timestream import ArchiveHandlePool, ZipContentFetcher
+    pool = ArchiveHandlePool(max_open=1)
+    with pool.open(data("timestreams/nested.zip"), "zip") as zfh:
+        first = zfh
+        assert len(zfh.namelist()) > 0
+    with pool.open(data("timestreams/nested.zip"), "zip") as zfh:
+        assert zfh is first
+    with pool.open(data("timestreams/nested.tar"), "tar") as tfh:
+        assert len(tfh.getnames()) > 0
+    # budget of one handle, so the zip should have been evicted
+    assert len(pool) == 1
+    with pool.open(data("timestreams/nested.zip"), "zip") as zfh:
+        assert zfh is not first
+    pool.close()
+    assert len(pool) == 0
+
+
+def test_tar_offset_index(data):
+    import tarfile
+    from pyts2.timestream import Fetcher, TarContentFetcher
+
+    stream = TimeStream(data("timestreams/nested.tar"))
+    files = list(stream.iter(tar_contents=False))
+    assert len(files) == 10
+    with tarfile.TarFile(data("timestreams/nested.tar")) as tar:
+        for file in files:
+            assert isinstance(file.fetcher, TarContentFetcher)
+            assert file.fetcher.member is not None
+            expect = tar.extractfile(file.fetcher.pathintar).read()
+            assert file.content == expect
+            # offsets survive a round trip through the index's json form
+            fetcher = Fetcher.from_json(file.fetcher.dict())
+            assert fetcher.member.offset_data == file.fetcher.member.offset_data
+            assert fetcher.get() == expect
+            # and fetchers without a known offset look it up in the pooled index
+            assert TarContentFetcher(file.fetcher.archivepath, file.fetcher.pathintar).get() == expect
+
+
+def test_writer_session(data, tmpdir):
+    import zipfile
+    outpath = tmpdir.join("output")
+    out = TimeStream(path=outpath, format="tif", bundle_level="month", name="output")
+    with out.writer(flush_every=3) as session:
+        for file in TimeStream(data("timestreams/nested")):
+            out.write(file)
+            out.write(file)  # duplicates are skipped, not re-added
+        assert len(session._bundles) == 1
+    assert len(session._bundles) == 0
+    with zipfile.ZipFile(str(tmpdir.join("output/2001/output_2001_02.tif.zip"))) as zfh:
+        assert len(zfh.namelist()) == 10
+    for i, file in enumerate(TimeStream(outpath)):
+        assert file.instant == TSInstant(SMALL_TIMESTREAMS["expect_times"][i], index=None)
+
+
+def test_parallel_writer(data, tmpdir):
+    expect = {
+        "output/2001/2001_02/output_2001_02_01.tif.zip",
+        "output/2001/2001_02/output_2001_02_02.tif.zip",
+    }
+    outpath = tmpdir.join("output")
+    out = TimeStream(path=outpath, format="tif", bundle_level="day", name="output")
+    with out.parallel_writer(3) as writer:
+        for file in TimeStream(data("timestreams/nested")):
+            writer.write(file)
+    assert writer.errors == []
+    assert set(find_files(tmpdir)) == {str(tmpdir.join(x)) for x in expect}
+    for i, file in enumerate(TimeStream(outpath)):
+        assert file.instant == TSInstant(SMALL_TIMESTREAMS["expect_times"][i], index=None)
+
+
+def test_parallel_writer_dead_worker(data, tmpdir):
+    out = TimeStream(path=tmpdir.join("output"), format="tif", bundle_level="day", name="output",
+                     onerror="skip")
+    writer = out.parallel_writer(1)
+    files = list(TimeStream(data("timestreams/nested")))
+    writer.write(files[0])
+    writer._procs[0].kill()
+    writer._procs[0].join()
+    writer.close()
+    assert len(writer.errors) == 1
+    assert "exited with code" in writer.errors[0]
+    assert files[0].filename in writer.errors[0]
+
+
+def test_content_view(data):
+    timestreams = [
+        data("timestreams/nested"),
+        data("timestreams/nested.zip"),
+        data("timestreams/nested.tar"),
+    ]
+    for timestream in timestreams:
+        for file in TimeStream(timestream).iter(tar_contents=False):
+            view = file.content_view
+            assert isinstance(view, memoryview)
+            assert file._content is None  # views don't load content
+            assert bytes(view) == file.fetcher.get()
+            assert file.md5sum == hashlib.md5(file.content).hexdigest()
+
+
+def test_prefetch(data):
+    stream = TimeStream(data("timestreams/nested"))
+    expect = [(f.instant, f.md5sum) for f in stream]
+    got = []
+    for file in TimeStream(data("timestreams/nested")).prefetch(nthreads=2, max_files=3, max_bytes=1):
+        assert file._content is not None
+        got.append((file.instant, file.md5sum))
+    assert got == expect
+
+
+def test_classify_without_extension(data, tmpdir):
+    import shutil
+    streamdir = tmpdir.mkdir("stream")
+    shutil.copy(data("timestreams/nested.zip"), str(streamdir.join("bundle.data")))
+    streamdir.join("notes.txt").write("not a bundle")
+    stream = TimeStream(str(streamdir))
+    assert stream._classify(str(streamdir.join("bundle.data")), "bundle.data") == "zip"
+    assert stream._classify(str(streamdir.join("notes.txt")), "notes.txt") is None
+    expect_insts = [TSInstant(t, index=None) for t in SMALL_TIMESTREAMS["expect_times"]]
+    assert [file.instant for file in stream] == expect_insts
+
+
+def test_parallel_scan(data):
+    for timestream in [data("timestreams/nested"), data("timestreams/zipball-day")]:
+        serial = [(f.filename, f.instant) for f in TimeStream(timestream, scan_threads=1)]
+        parallel = [(f.filename, f.instant) for f in TimeStream(timestream, scan_threads=4)]
+        assert len(serial) == 10
+        assert serial == parallel
+
+
+def test_filter_prunes_dirs(data, monkeypatch):
+    import pyts2.timestream
+    listed = []
+    listdir = pyts2.timestream._listdir
+
+    def recording_listdir(top):
+        listed.append(op.basename(top.rstrip("/")))
+        return listdir(top)
+    monkeypatch.setattr(pyts2.timestream, "_listdir", recording_listdir)
+
+    tfilter = TimeFilter(dt.date(2001, 2, 1), dt.date(2001, 2, 1),
+                         dt.time(10, 0, 0), dt.time(12, 0, 0))
+    stream = TimeStream(data("timestreams/nested"), timefilter=tfilter)
+    assert [str(f.instant) for f in stream] == ["2001_02_01_10_14_15", "2001_02_01_11_14_15"]
+    assert "2001_02_02" not in listed
+    assert "2001_02_01_09" not in listed
+    assert "2001_02_01_10" in listed
+
+
+def test_filter_keeps_other_dirs(data, tmpdir):
+    # directories that merely look like dates aren't skipped, nor do they stop the walk
+    shutil.copytree(data("timestreams/flat"), str(tmpdir.join("0001")))
+    shutil.copytree(data("timestreams/flat"), str(tmpdir.join("2001_13")))
+    tfilter = TimeFilter(dt.date(2001, 2, 1), dt.date(2001, 2, 1))
+    got = [op.relpath(f.fetcher.pathondisk, str(tmpdir)) for f in TimeStream(str(tmpdir), timefilter=tfilter)]
+    assert len(got) == 10
+    assert {op.dirname(x) for x in got} == {"0001", "2001_13"}
+
+
+def age(path):
+    """Backdate everything under `path`, as the index doesn't trust very recent mtimes"""
+    if op.isfile(path):
+        os.utime(path, ns=(10**18, 10**18))
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files + ["."]:
+            os.utime(op.join(root, name), ns=(10**18, 10**18))
+
+
+def test_binary_index(data, tmpdir, monkeypatch):
+    import shutil
+    from pyts2.index import TimeStreamIndex
+
+    for name in ["nested", "nested.tar", "gvlike"]:
+        path = str(tmpdir.join(name))
+        if op.isdir(data(f"timestreams/{name}")):
+            shutil.copytree(data(f"timestreams/{name}"), path)
+        else:
+            shutil.copy(data(f"timestreams/{name}"), path)
+        age(path)
+        expect = {f.instant: f.content for f in TimeStream(path)}
+
+        stream = TimeStream(path, write_index=True)
+        assert stream.instants == sorted(expect)
+        assert op.exists(stream._index_file)
+
+        # a fresh stream maps the saved index rather than rescanning
+        stream = TimeStream(path)
+        with monkeypatch.context() as m:
+            m.setattr(TimeStream, "iter", None)
+            assert stream.instants == sorted(expect)
+            for instant, content in expect.items():
+                assert stream.getinstant(instant).content == content
+                file = stream.getinstant(instant)
+                assert stream[file.filename].content == content
+            with pytest.raises(KeyError):
+                stream.getinstant(TSInstant(dt.datetime(1999, 1, 1)))
+            with pytest.raises(KeyError):
+                stream["Not a file"]
+        assert isinstance(stream._index, TimeStreamIndex)
+        assert stream._index._mmap is not None
+
+
+def test_legacy_json_index(data, tmpdir):
+    import json
+    import shutil
+
+    path = str(tmpdir.join("nested"))
+    shutil.copytree(data("timestreams/nested"), path)
+    files = list(TimeStream(path))
+    with open(op.join(path, "index.json"), "w") as fh:
+        for file in files:
+            print(json.dumps({"type": "file", "path": str(file.fetcher.pathondisk)}), file=fh)
+    stream = TimeStream(path)
+    stream.index()
+    assert len(stream._index) == len(files)
+    assert stream.instants == [f.instant for f in files]
+
+
+def test_index_refresh(data, tmpdir, monkeypatch):
+    import shutil
+    import pyts2.timestream
+
+    path = str(tmpdir.join("nested"))
+    shutil.copytree(data("timestreams/nested"), path)
+    age(path)
+    expect = [f.instant for f in TimeStream(path)]
+    TimeStream(path, write_index=True).index()
+    age(path)
+
+    listed = []
+    listdir = pyts2.timestream._listdir
+
+    def recording_listdir(top):
+        listed.append(op.relpath(top, path))
+        return listdir(top)
+    monkeypatch.setattr(pyts2.timestream, "_listdir", recording_listdir)
+
+    # unchanged: nothing is listed, except the top level, which the index's lock file touches
+    assert TimeStream(path).instants == expect
+    assert set(listed) <= {"."}
+
+    # add a file to one hour, remove one from another, and add a new day
+    day1 = op.join(path, "2001", "2001_02", "2001_02_01")
+    shutil.copy(op.join(day1, "2001_02_01_10", "2001_02_01_10_14_15_00.tif"),
+                op.join(day1, "2001_02_01_10", "2001_02_01_10_44_15_00.tif"))
+    os.unlink(op.join(day1, "2001_02_01_12", "2001_02_01_12_14_15_00.tif"))
+    os.mkdir(op.join(path, "2001", "2001_02", "2001_02_03"))
+    shutil.copy(op.join(day1, "2001_02_01_09", "2001_02_01_09_14_15_00.tif"),
+                op.join(path, "2001", "2001_02", "2001_02_03", "2001_02_03_09_14_15_00.tif"))
+    expect = [f.instant for f in TimeStream(path)]
+    listed.clear()
+    stream = TimeStream(path, write_index=True)
+    assert stream.instants == expect
+    assert set(listed) - {"."} == {"2001/2001_02", "2001/2001_02/2001_02_03",
+                           "2001/2001_02/2001_02_01/2001_02_01_10",
+                           "2001/2001_02/2001_02_01/2001_02_01_12"}
+    for instant in expect:
+        assert stream.getinstant(instant).content is not None
+
+    # and a changed archive is re-read
+    path = str(tmpdir.join("zipball-day"))
+    shutil.copytree(data("timestreams/zipball-day"), path)
+    age(path)
+    TimeStream(path, write_index=True).index()
+    with zipfile.ZipFile(op.join(path, "2001", "2001_02", "nested_2001_02_02.zip"), "a") as zip:
+        zip.writestr("2001_02_02_14_14_15_00.tif", b"new")
+    stream = TimeStream(path)
+    assert stream.instants[-1] == TSInstant.from_path("2001_02_02_14_14_15_00")
+    assert stream.getinstant(stream.instants[-1]).content == b"new"
+    assert len(stream.instants) == 11
+
+
+def test_index_settles(data, tmpdir, monkeypatch):
+    import time
+    import pyts2.timestream
+    from pyts2.index import TimeStreamIndex
+
+    # a freshly copied stream's directories are too recent to trust when first indexed
+    path = str(tmpdir.join("nested"))
+    shutil.copytree(data("timestreams/nested"), path)
+    for root, dirs, files in os.walk(path):
+        os.utime(root)
+    TimeStream(path, write_index=True).index()
+    assert -1 in TimeStreamIndex.load(op.join(path, "index.tsidx")).meta["dirs"].values()
+
+    listed = []
+    listdir = pyts2.timestream._listdir
+
+    def recording_listdir(top):
+        listed.append(op.relpath(top, path))
+        return listdir(top)
+    monkeypatch.setattr(pyts2.timestream, "_listdir", recording_listdir)
+    now = time.time_ns
+    monkeypatch.setattr(time, "time_ns", lambda: now() + 3 * 10**9)
+
+    # once they've settled, they're listed once more, and the index is saved
+    assert len(TimeStream(path).instants) == 10
+    assert len(listed) == 15
+    assert -1 not in TimeStreamIndex.load(op.join(path, "index.tsidx")).meta["dirs"].values()
+    for _ in range(3):
+        listed.clear()
+        assert len(TimeStream(path).instants) == 10
+        assert set(listed) <= {"."}
+
+
+def test_index_delta(data, tmpdir, monkeypatch):
+    files = list(TimeStream(data("timestreams/nested")))
+    for bundle in ["month", "none"]:
+        outpath = str(tmpdir.join(bundle))
+        out = TimeStream(path=outpath, format="tif", bundle_level=bundle, name="output")
+        with out.writer():
+            for file in files[:5]:
+                out.write(file)
+        TimeStream(outpath, write_index=True).index()
+        age(outpath)
+
+        # writes are logged, once per session flush, instead of invalidating the index
+        with out.writer(flush_every=3):
+            for file in files[5:9]:
+                out.write(file)
+        out.write(files[9])
+        with open(out._index_delta_file) as fh:
+            assert len(fh.readlines()) == 3
+
+        # and a reader merges the log, without rescanning the bundle
+        with monkeypatch.context() as m:
+            m.setattr(TimeStream, "_walk_archive", None)
+            stream = TimeStream(outpath)
+            assert stream.instants == [f.instant for f in files]
+            assert stream.getinstant(files[9].instant).content == files[9].content
+        assert not op.exists(out._index_delta_file)
+
+
+def test_range_nearest(data):
+    for timestream in [data("timestreams/nested"), data("timestreams/zipball-day")]:
+        stream = TimeStream(timestream)
+        day1 = [dt.datetime(2001, 2, 1, h, 14, 15) for h in range(9, 14)]
+        assert [f.instant.datetime for f in stream.range(dt.datetime(2001, 2, 1), dt.datetime(2001, 2, 2))] == day1
+        assert [f.instant.datetime for f in stream.range(TSInstant(day1[1]), TSInstant(day1[3]))] == day1[1:3]
+        assert len(list(stream.range(start=dt.datetime(2001, 2, 2)))) == 5
+        assert len(list(stream.range(end=dt.datetime(2001, 2, 1, 10)))) == 1
+        assert list(stream.range(dt.datetime(2001, 2, 3), dt.datetime(2001, 2, 1))) == []
+
+        noon = dt.datetime(2001, 2, 1, 12)
+        assert stream.nearest(noon).instant.datetime == dt.datetime(2001, 2, 1, 12, 14, 15)
+        assert stream.nearest(noon, tolerance=dt.timedelta(minutes=15)).instant.datetime == \
+            dt.datetime(2001, 2, 1, 12, 14, 15)
+        with pytest.raises(KeyError):
+            stream.nearest(noon, tolerance=dt.timedelta(minutes=10))
+        assert stream.nearest(dt.datetime(1999, 1, 1)).instant.datetime == day1[0]
+        assert stream.nearest(dt.datetime(2001, 2, 1, 11, 44, 15)).instant.datetime == day1[2]
+
+    stream = TimeStream(data("timestreams/gvlike"))
+    third = TSInstant.from_path("gvlike_2001_02_01_09_14_15_00_03.tif")
+    assert stream.nearest(third).instant == third
+
+    tfilter = TimeFilter(dt.date(2001, 2, 1), dt.date(2001, 2, 1),
+                         dt.time(10, 0, 0), dt.time(12, 0, 0))
+    stream = TimeStream(data("timestreams/nested"), timefilter=tfilter)
+    assert stream.nearest(dt.datetime(2001, 2, 1, 13)).instant.datetime == dt.datetime(2001, 2, 1, 11, 14, 15)
+    assert len(list(stream.range())) == 2
+
+
+def test_subsample(data):
+    stream = TimeStream(data("timestreams/nested"))
+    hours = dt.timedelta(hours=1)
+    assert [f.instant.datetime for f in stream.subsample(hours)] == SMALL_TIMESTREAMS["expect_times"]
+    assert [f.instant.datetime for f in stream.subsample(4 * hours)] == [
+        dt.datetime(2001, 2, 1,  9, 14, 15),
+        dt.datetime(2001, 2, 1, 12, 14, 15),
+        dt.datetime(2001, 2, 2,  9, 14, 15),
+        dt.datetime(2001, 2, 2, 12, 14, 15),
+    ]
+    # 08:00-12:00 and 12:00-16:00; centres at 10:00 and 14:00
+    assert [f.instant.datetime for f in stream.subsample(4 * hours, align="centre")] == [
+        dt.datetime(2001, 2, 1, 10, 14, 15),
+        dt.datetime(2001, 2, 1, 13, 14, 15),
+        dt.datetime(2001, 2, 2, 10, 14, 15),
+        dt.datetime(2001, 2, 2, 13, 14, 15),
+    ]
+    assert [f.instant.datetime for f in stream.subsample(dt.timedelta(days=1), align="centre")] == [
+        dt.datetime(2001, 2, 1, 12, 14, 15),
+        dt.datetime(2001, 2, 2, 12, 14, 15),
+    ]
+
+    tfilter = TimeFilter(dt.date(2001, 2, 1), dt.date(2001, 2, 1),
+                         dt.time(10, 0, 0), dt.time(12, 0, 0))
+    stream = TimeStream(data("timestreams/nested"), timefilter=tfilter)
+    assert [f.instant.datetime for f in stream.subsample(4 * hours)] == [dt.datetime(2001, 2, 1, 10, 14, 15)]
+    with pytest.raises(ValueError):
+        list(stream.subsample(hours, align="last"))
+    for interval in (dt.timedelta(0), -hours, dt.timedelta(seconds=1.5)):
+        with pytest.raises(ValueError):
+            stream.subsample(interval)
+
+
+def test_index_queries_keep_to_format(data, tmpdir):
+    path = str(tmpdir.join("nested"))
+    shutil.copytree(data("timestreams/nested"), path)
+    hour = op.join(path, "2001", "2001_02", "2001_02_01", "2001_02_01_10")
+    shutil.copy(op.join(hour, "2001_02_01_10_14_15_00.tif"), op.join(hour, "2001_02_01_10_44_15_00.jpg"))
+    TimeStream(path, write_index=True).index()
+
+    # the saved index has every format, but queries only give those of the stream's
+    stream = TimeStream(path, format="jpg")
+    assert [f.filename for f in stream.range()] == ["2001_02_01_10_44_15_00.jpg"]
+    assert [f.filename for f in stream.subsample(dt.timedelta(hours=1))] == ["2001_02_01_10_44_15_00.jpg"]
+    assert stream.nearest(dt.datetime(2001, 2, 2)).filename == "2001_02_01_10_44_15_00.jpg"
+    assert len(stream.instants) == 1
+    tfilter = TimeFilter(dt.date(2001, 2, 1), dt.date(2001, 2, 1), dt.time(10, 0, 0), dt.time(10, 30, 0))
+    stream = TimeStream(path, format="tif", timefilter=tfilter)
+    assert [f.filename for f in stream.subsample(dt.timedelta(minutes=15))] == ["2001_02_01_10_14_15_00.tif"]
+    assert [f.filename for f in TimeStream(path, format="jpg", timefilter=tfilter).range()] == []
+
+
+def test_join_timestreams(data):
+    from pyts2.timestream import TimestreamFile, join_timestreams
+
+    def instants(pairs):
+        return [(l.instant.datetime if l is not None else None,
+                 r.instant.datetime if r is not None else None) for l, r in pairs]
+
+    stream = TimeStream(data("timestreams/nested"))
+    zipped = TimeStream(data("timestreams/zipball-day"))
+    pairs = list(join_timestreams(stream, zipped))
+    assert len(pairs) == 10
+    assert all(l.instant == r.instant for l, r in pairs)
+
+    times = SMALL_TIMESTREAMS["expect_times"]
+    left = list(stream.range(times[0], times[3]))
+    right = list(zipped.range(times[2], times[5]))
+    assert instants(join_timestreams(left, right)) == [
+        (times[0], None), (times[1], None), (times[2], times[2]), (None, times[3]), (None, times[4]),
+    ]
+
+    # with a tolerance, files an hour apart pair off, each matching its nearest
+    shifted = [TimestreamFile(instant=TSInstant(f.instant.datetime + dt.timedelta(minutes=50)),
+                              filename="x", content=b"")
+               for f in left]
+    assert instants(join_timestreams(shifted, right, tolerance=dt.timedelta(hours=1))) == [
+        (shifted[0].instant.datetime, None), (shifted[1].instant.datetime, times[2]),
+        (shifted[2].instant.datetime, times[3]), (None, times[4]),
+    ]
+
+    # left files at the same instant all match the one right file
+    doubled = [f for f in left for _ in range(2)]
+    assert instants(join_timestreams(doubled, right)) == [
+        (times[0], None), (times[0], None), (times[1], None), (times[1], None),
+        (times[2], times[2]), (times[2], times[2]), (None, times[3]), (None, times[4]),
+    ]
+    assert instants(join_timestreams(shifted + shifted[-1:], right, tolerance=dt.timedelta(hours=1)))[2:4] == [
+        (shifted[2].instant.datetime, times[3]), (shifted[2].instant.datetime, times[3]),
+    ]
+
+    with pytest.raises(ValueError):
+        list(join_timestreams(list(reversed(left)), right))
+
+
+def test_descriptor(data):
+    import pickle
+    from pyts2.timestream import TimestreamFile
+    timestreams = [
+        data("timestreams/nested"),
+        data("timestreams/nested.zip"),
+        data("timestreams/nested.tar"),
+    ]
+    for timestream in timestreams:
+        for file in TimeStream(timestream).iter(tar_contents=False):
+            file.report["Note"] = "hi"
+            desc = file.descriptor()
+            assert "content" not in desc
+            assert len(pickle.dumps(desc)) < 1000
+            copied = TimestreamFile.from_descriptor(pickle.loads(pickle.dumps(desc)))
+            assert copied.instant == file.instant
+            assert copied.filename == file.filename
+            assert copied.report == {"Note": "hi"}
+            assert copied.md5sum == file.md5sum
+            file.content
+            assert "content" not in file.descriptor()
+
+    inmem = TimestreamFile.from_bytes(b"abc", "2001_02_01_09_14_15_00.tif")
+    copied = TimestreamFile.from_descriptor(inmem.descriptor())
+    assert copied.content == b"abc"
+    assert copied.format == "tif"
+
+
+def test_archive_pool_pinning(data):
+    from pyts2.timestream import ArchiveHandlePool
+    pool = ArchiveHandlePool(max_open=1)
+    with pool.open(data("timestreams/nested.zip"), "zip") as zfh:
+        # evicting the zip while it's in use mustn't close it under us
+        with pool.open(data("timestreams/nested.tar"), "tar"):
+            pass
+        assert len(pool) == 1
+        assert zfh.fp is not None
+        assert len(zfh.read(zfh.namelist()[-1])) > 0
+    # but it is closed once we're done with it
+    assert zfh.fp is None
+    pool.close()
+
+
+def test_archive_pool_one_slot_per_archive(data):
+    from pyts2.timestream import ArchiveHandlePool
+    pool = ArchiveHandlePool(max_open=1)
+    tarpath = data("timestreams/nested.tar")
+    with pool.open(tarpath, "tar") as tfh:
+        name = tfh.getnames()[-1]
+    member = pool.tar_member(tarpath, name)
+    first = pool.pread(tarpath, member.offset_data, member.size)
+    assert bytes(pool.view(tarpath, member.offset_data, member.size)) == first
+    # the tar's handle, raw file and mmap share one slot, so nothing was evicted
+    assert len(pool) == 1
+    with pool.open(tarpath, "tar") as tfh:
+        assert tfh.extractfile(name).read() == first
+    pool.close()
+
+
+def test_archive_pool_opens_outside_lock(data):
+    import threading
+    from pyts2.timestream import ArchiveHandlePool
+    pool = ArchiveHandlePool()
+    opening, proceed = threading.Event(), threading.Event()
+    open_archive = pool._open
+
+    def slow_open(path, kind):
+        if kind == "tar":
+            opening.set()
+            proceed.wait(10)
+        return open_archive(path, kind)
+    pool._open = slow_open
+
+    thread = threading.Thread(target=pool.tar_member, args=(data("timestreams/nested.tar"), "x"))
+    thread.start()
+    assert opening.wait(10)
+    # other archives can be used while the tar is still being opened
+    with pool.open(data("timestreams/nested.zip"), "zip") as zfh:
+        assert len(zfh.namelist()) > 0
+    assert not proceed.is_set()
+    proceed.set()
+    thread.join()
+    pool.close()
+
+
+def test_writer_session_leaves_bundle_readable(data, tmpdir):
+    import zipfile
+    outpath = tmpdir.join("output")
+    out = TimeStream(path=outpath, format="tif", bundle_level="month", name="output")
+    files = list(TimeStream(data("timestreams/nested")))
+    out.write(files[0])
+    bundle = str(tmpdir.join("output/2001/output_2001_02.tif.zip"))
+    with out.writer() as session:
+        for file in files[1:]:
+            out.write(file)
+        # mid-session, the bundle is still a valid zip with its old members, and isn't locked
+        with zipfile.ZipFile(bundle) as zfh:
+            assert len(zfh.namelist()) == 1
+        assert not op.exists(bundle + ".lock")
+    with zipfile.ZipFile(bundle) as zfh:
+        assert len(zfh.namelist()) == 10
+    assert os.listdir(str(tmpdir.join("output/2001"))) == ["output_2001_02.tif.zip"]